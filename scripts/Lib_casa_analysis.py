@@ -6,27 +6,559 @@ import os
 import sys
 import numpy as np
 import glob
+import copy
+import json
+import time
+import hashlib
 
 sys.path.append(os.environ.get('CASA_AU_PATH'))
 import analysisUtils as aU
 import almaqa2csg as csg
+import Lib_rundb as RunDB
+import Lib_fileops as FileOps
+
+# the scripts directory (the working directory changes to the ASDM at step0), also on sys.path
+# for the spawned plot workers
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+if not scriptdir in sys.path:
+    sys.path.append(scriptdir)
+
+def _jsonable(obj):
+    if isinstance(obj,np.ndarray):
+        return obj.tolist()
+    if isinstance(obj,np.generic):
+        return obj.item()
+    return str(obj)
+
+# {path: size} of every file below top
+def file_sizes(top):
+    sizes = {}
+    for root,dirs,files in os.walk(top):
+        for f in files:
+            path = os.path.join(root,f)
+            try:
+                sizes[path] = os.lstat(path).st_size
+            except OSError:
+                pass
+    return sizes
+
+def du(path):
+    if os.path.isdir(path):
+        return sum(file_sizes(path).values())
+    elif os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+# unit of work of step5: the chain of one (field, spw) on its own copy of the analysis state
+def uvfit_unit(obj,field,spw,dryrun=False):
+    unit = copy.copy(obj)
+    key = '5/'+field+'/spw_'+spw
+    record = unit.record_start(key,'uvfit_chain',disk=False)
+    try:
+        unit.uvfit_chain(field,spw,dryrun=dryrun)
+    except Exception as e:
+        unit.record_end(record,status='failed',error=repr(e),ms=glob.glob('calibrated/'+unit.visname+'.split.'+field+'.spw_'+spw+'*'))
+        return {'key':key,'status':'failed','error':repr(e),'outputs':[]}
+    unit.record_end(record,ms=glob.glob('calibrated/'+unit.visname+'.split.'+field+'.spw_'+spw+'*'))
+
+    outputs = glob.glob('./specdata/'+unit.visname+'.split.'+field+'.spw_'+spw+'*.dat')
+    return {'key':key,'status':'OK','error':None,'outputs':outputs}
+
+# the same unit in a fresh CASA process (obj.casacmd): a fork of a CASA process would share its
+# casatools state (threads, open tables), so parallel chains each get their own CASA.
+# obj is passed as a pickle, the result comes back as json, logs go to log/uvfit_unit.<field>.spw_<spw>.*
+def uvfit_unit_process(obj,field,spw,dryrun=False):
+    import pickle
+    import shlex
+    import subprocess
+    key = '5/'+field+'/spw_'+spw
+    jobbase = './log/uvfit_unit.'+field+'.spw_'+spw
+    FileOps.mkdir_p('log')
+    FileOps.rm_rf(jobbase+'.json')
+    with open(jobbase+'.pkl','wb') as f:
+        pickle.dump(obj,f)
+
+    f = open(jobbase+'.job.py','w')
+    f.write('import sys,json,pickle'+'\n')
+    f.write('sys.path.append('+repr(scriptdir)+')'+'\n')
+    f.write('import Lib_casa_analysis as Lib'+'\n')
+    f.write('obj = pickle.load(open('+repr(jobbase+'.pkl')+',"rb"))'+'\n')
+    f.write('result = Lib.uvfit_unit(obj,'+repr(field)+','+repr(spw)+',dryrun='+repr(dryrun)+')'+'\n')
+    f.write('json.dump(result,open('+repr(jobbase+'.json')+',"w"))'+'\n')
+    f.close()
+
+    cmd = shlex.split(obj.casacmd)+['--nologger','--nogui','--logfile',jobbase+'.casa.log','-c',jobbase+'.job.py']
+    with open(jobbase+'.term.log','w') as log:
+        ret = subprocess.call(cmd,stdout=log,stderr=subprocess.STDOUT)
+
+    if os.path.exists(jobbase+'.json'):
+        with open(jobbase+'.json','r') as f:
+            result = json.load(f)
+    else:
+        result = {'key':key,'status':'failed','error':'casa exit status '+str(ret)+' (see '+jobbase+'.term.log)','outputs':[]}
+    FileOps.rm_rf(jobbase+'.pkl',jobbase+'.json')
+    return result
+
+# point source at the phase centre: the Stokes I flux of each channel is the weighted mean of the
+# real part of the XX/YY visibilities (cross hands of 4-pol data are left out), error
+# sqrt(redchi2/sum w) as in uvmultifit. Sums are additive over row chunks.
+#   data, flag: [npol,nchan,nrow], weight: [npol,nchan,nrow] (WEIGHT_SPECTRUM) or [npol,nrow] (WEIGHT)
+def pointsource_sums(data,weight,flag,mfs=False):
+    if weight.ndim == 2:
+        weight = weight[:,np.newaxis,:]
+    # correlations XX,XY,YX,YY (or XX,YY / XX)
+    pol = parallel_hands(data.shape[0])
+    data,weight,flag = data[pol],weight[pol],flag[pol]
+    w = np.where(flag,0.,weight)
+    axis = (0,1,2) if mfs else (0,2)
+    return {
+        'w':w.sum(axis=axis),
+        'wre':(w*data.real).sum(axis=axis),
+        'wabs2':(w*(data.real**2+data.imag**2)).sum(axis=axis),
+        'n':(~flag).sum(axis=axis),
+        }
+
+def parallel_hands(npol):
+    if npol == 4:
+        return [0,3]
+    return list(range(npol))
+
+def add_sums(sums0,sums1):
+    if sums0 == None:
+        return sums1
+    return dict([(k,sums0[k]+sums1[k]) for k in sums0])
+
+def pointsource_fit(sums):
+    with np.errstate(divide='ignore',invalid='ignore'):
+        flux = sums['wre']/sums['w']
+        # sum w|V-flux|^2 over real and imaginary parts, 1 free parameter
+        chi2 = sums['wabs2'] - 2.*flux*sums['wre'] + flux**2*sums['w']
+        redchi2 = chi2/(2.*sums['n']-1.)
+        # weights scaled to the scatter of the data (redchi2 = 1)
+        err = np.sqrt(redchi2/sums['w'])
+    return flux,err,redchi2
+
+# peak RSS [byte] reached between two getrusage() calls, None if the lifetime maximum did not rise
+def step_maxrss(ru0,ru1):
+    if ru1.ru_maxrss > ru0.ru_maxrss:
+        return ru1.ru_maxrss*1024
+    return None
+
+# rows per chunk so that `copies` arrays of the given columns stay within memlimit [byte]
+def row_chunksize(tb,columns,memlimit,copies=3):
+    nrow = tb.nrows()
+    if nrow == 0:
+        return 1
+    rowbytes = 0
+    for col in columns:
+        if tb.iscelldefined(col,0):
+            rowbytes = rowbytes + np.asarray(tb.getcell(col,0)).nbytes
+    return int(max(1,min(nrow,memlimit//max(1,copies*rowbytes))))
+
+# rows of tables matched by (TIME, ANTENNA1, ANTENNA2): index into base for every row of keys, -1 if absent
+def baseline_keys(tb):
+    keys = np.zeros(tb.nrows(),dtype=[('time','f8'),('ant1','i4'),('ant2','i4')])
+    keys['time'] = tb.getcol('TIME')
+    keys['ant1'] = tb.getcol('ANTENNA1')
+    keys['ant2'] = tb.getcol('ANTENNA2')
+    return keys
+
+def match_rows(base,keys):
+    order = np.argsort(base)
+    idx = np.minimum(np.searchsorted(base[order],keys),base.shape[0]-1)
+    return np.where(base[order][idx] == keys,order[idx],-1)
+
+# gain plot of one caltable pair (solutions of the 1st/2nd selfcal round) with the Agg backend,
+# no pyplot state: safe to render in worker processes
+#   plot: {'title','type','time0','gain0' [npol,nrow],'time1','gain1','outbase'}
+def gainplot_figure(plot):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.set_title(plot['title'])
+    if plot['type'] == 'phase':
+        for gain in plot['gain0']:
+            ax.scatter((plot['time0']-plot['time0'][0])/60.,np.angle(gain,deg=True),c='b',s=2)
+        ax.scatter((plot['time1']-plot['time1'][0])/60.,np.angle(plot['gain1'][0],deg=True),c='r',s=1)
+        ax.set_ylabel('Gain phase [deg]')
+    elif plot['type'] == 'amp_phase':
+        ax.scatter((plot['time0']-plot['time0'][0])/60.,np.abs(plot['gain0'][0]),c='b',s=2)
+        ax.scatter((plot['time1']-plot['time1'][0])/60.,np.abs(plot['gain1'][0]),c='r',s=1)
+        ax.set_ylabel('Gain amplitude')
+    ax.set_xlabel('Time from the first integration [min]')
+    return fig
+
+def render_gainplot(plot,formats=['png','pdf']):
+    fig = gainplot_figure(plot)
+    outfiles = []
+    for fmt in formats:
+        fig.savefig(plot['outbase']+'.'+fmt)
+        outfiles.append(plot['outbase']+'.'+fmt)
+    return outfiles
+
+# continuum (1st order fit to the 3 sigma clipped spectrum), rms of line/continuum and clipped channels;
+# clipped channels below the continuum are absorption candidates
+def spectral_summary(freq,spec,sigma=3.):
+    from astropy import stats
+    spec_ma = stats.sigma_clip(spec,sigma=sigma)
+    pp = np.ma.polyfit(freq,spec_ma,deg=1)
+    cont = pp[0]*freq+pp[1]
+    rms = np.ma.std(spec_ma/cont)
+    clipped = np.flatnonzero(np.ma.getmaskarray(spec_ma))
+    absorption = clipped[spec[clipped] < cont[clipped]]
+    return {
+        'nchan':int(freq.shape[0]),
+        'cont':[float(pp[0]),float(pp[1])],
+        'rms':float(rms),
+        'clipped':clipped.tolist(),
+        'absorption':absorption.tolist(),
+        'absorption_freq':freq[absorption].tolist(),
+        }
+
+# line/continuum plot of one spectrum from its summary entry (Agg backend, no pyplot state)
+#   plot: {'specfile','summary','title','outbase','formats'}
+def render_specplot(plot):
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    data = np.loadtxt(plot['specfile'])
+    freq = data[:,0]/1.0e9 #GHz
+    spec = data[:,1] #Jy
+    summary = plot['summary']
+    cont = summary['cont'][0]*freq+summary['cont'][1]
+    rms = summary['rms']
+    detect = np.ma.array(np.full_like(freq,np.max(np.delete(spec/cont,summary['clipped']))+2.5*rms),mask=True)
+    detect.mask[summary['clipped']] = False
+
+    rc = {'font.family':'Times New Roman','mathtext.fontset':'stix','figure.dpi':200,'font.size':20}
+    with matplotlib.rc_context(rc):
+        fig = Figure(figsize=[10,8])
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        ax.step(freq,spec/cont,where='mid',c='b',lw=1)
+        ax.plot(freq,detect,'r-',lw=5)
+        ax.set_xlabel('frequency [GHz]')
+        ax.set_ylabel('line/continuum')
+        ax.set_title(plot['title'])
+        ax.set_ylim(np.min(spec/cont)-5*rms,np.max(spec/cont)+5*rms)
+        for fmt in plot['formats']:
+            fig.savefig(plot['outbase']+'.'+fmt)
+
+# warm uvmultifit worker (uvmultifit_worker.py running in casacmdforuvfit, CASA 5.6 / python 2.7)
+# jobs and replies are json over a multiprocessing connection, so both python versions can read them
+class UVFitService():
+
+    def __init__(self,casacmd,workerscript=None,timeout=600.):
+        self.casacmd = casacmd
+        if workerscript == None:
+            workerscript = os.path.join(scriptdir,'uvmultifit_worker.py')
+        self.workerscript = workerscript
+        self.timeout = timeout
+        self.conn = None
+
+    def start(self):
+        import shlex
+        import binascii
+        import threading
+        import subprocess
+        from multiprocessing.connection import Listener
+
+        authkey = os.urandom(16)
+        listener = Listener(('localhost',0),authkey=authkey)
+        env = os.environ.copy()
+        env['ALMAQSO_UVFIT_ADDRESS'] = 'localhost:'+str(listener.address[1])
+        env['ALMAQSO_UVFIT_AUTHKEY'] = binascii.hexlify(authkey).decode()
+
+        cmd = shlex.split(self.casacmd)+['--nologger','--nogui','--nologfile','-c',self.workerscript]
+        self.proc = subprocess.Popen(cmd,env=env)
+
+        accepted = []
+        th = threading.Thread(target=lambda: accepted.append(listener.accept()),daemon=True)
+        th.start()
+        th.join(self.timeout)
+        listener.close()
+        if accepted == []:
+            self.proc.kill()
+            raise RuntimeError('uvmultifit worker did not start: '+' '.join(cmd))
+        self.conn = accepted[0]
+
+    def fit(self,kw_uvfit):
+        self.conn.send_bytes(json.dumps({'kw_uvfit':kw_uvfit,'cwd':os.getcwd()}).encode())
+        reply = json.loads(self.conn.recv_bytes().decode())
+        if reply['status'] != 'OK':
+            raise RuntimeError('uvmultifit failed: '+reply['error'])
+
+    def stop(self):
+        if self.conn != None:
+            try:
+                self.conn.send_bytes(json.dumps(None).encode())
+                self.conn.close()
+            except OSError:
+                pass
+            self.proc.wait()
+            self.conn = None
+
+# one warm uvmultifit worker per process and CASA command (uvfit chains in their own CASA process
+# start their own; those exit when the chain process closes its connection)
+_uvfitservices = {}
+
+def uvfitservice(casacmd):
+    key = (os.getpid(),casacmd)
+    if not key in _uvfitservices:
+        service = UVFitService(casacmd)
+        service.start()
+        _uvfitservices[key] = service
+    return _uvfitservices[key]
+
+def stop_uvfitservices():
+    for key in list(_uvfitservices):
+        if key[0] == os.getpid():
+            _uvfitservices.pop(key).stop()
 
 class QSOanalysis():
 
-    def __init__(self,tarfilename,casacmd='casa',casacmdforuvfit='casa',spacesave=False,workingDir=None):
+    # attributes restored from the checkpoint manifest when a step is skipped
+    statekeys = ['asdmfile','visname','spws','refant','dish_diameter','fields','beamsize','imsize','cell']
+
+    # onlyasdm: extract only the raw/*.asdm.sdm members of the tarball
+    # tarpolicy: what happens to the source tarball, 'compress' (gzip in spacesaving), 'keep' or 'drop' (removed after extraction)
+    # fusesplit: read <vis>.split once into a calibrator-only MS and cut the per-field/spw MSes from it
+    # listobs: write .listobs dumps next to the split MSes
+    # uvfit_nproc: number of (field, spw) chains of step5 run in parallel (one CASA process each)
+    # uvfitbackend: how uvmultifit runs, 'casa' (one casacmdforuvfit process per fit), 'worker' (a warm
+    #   casacmdforuvfit process receiving fits over a local socket), 'inprocess' (NordicARC importable here)
+    #   or 'numpy' (built-in point-source fitter, uvfit_numpy)
+    # memlimit: memory ceiling [byte] for the visibility columns held by the table I/O of step5
+    # plotformats: output formats of the gain plots, 'png', 'pdf' or 'multipdf' (one multi-page pdf per ASDM)
+    # flagman: sigma-clip the selfcal residuals of the averaged MS (uvfit_flag_man) before the 2nd selfcal round
+    # allspw: after step5, combine the .avg MSes of each field into one (avgspws), fitted and imaged in step6
+    def __init__(self,tarfilename,casacmd='casa',casacmdforuvfit='casa',spacesave=False,workingDir=None,resume=False,onlyasdm=False,tarpolicy='compress',
+                 fusesplit=False,listobs=True,uvfit_nproc=1,uvfitbackend='casa',memlimit=2*1024**3,allspw=False,plotformats=['png','pdf'],flagman=False):
         self.tarfilename = tarfilename
         self.workingDir = workingDir
         self.spacesave = spacesave
         self.casacmd = casacmd
         self.casacmdforuvfit = casacmdforuvfit
+        self.resume = resume
+        self.onlyasdm = onlyasdm
+        self.tarpolicy = tarpolicy
+        self.fusesplit = fusesplit
+        self.listobs = listobs
+        self.uvfit_nproc = uvfit_nproc
+        self.uvfitbackend = uvfitbackend
+        self.memlimit = memlimit
+        self.allspw = allspw
+        self.plotformats = plotformats
+        self.flagman = flagman
 
         self.projID = tarfilename.split('_uid___')[0]
         self.asdmname = 'uid___' + (tarfilename.split('_uid___')[1]).replace('.asdm.sdm.tar','')
 
+        if workingDir!=None:
+            self.asdmdir = os.path.abspath(os.path.join(workingDir,self.asdmname))
+        else:
+            self.asdmdir = os.path.abspath(self.asdmname)
+        self.checkpointfile = os.path.join(self.asdmdir,'log',self.asdmname+'.checkpoint.json')
+        self.checkpoint = self.load_checkpoint()
+        self.stepsfile = os.path.join(self.asdmdir,'log',self.asdmname+'.steps.jsonl')
+
     def writelog(self,content=''):
-        os.system('mkdir -p log')
-        os.system('touch ./log/'+self.asdmname+'.analysis.v2.log')
-        os.system('echo "'+content+'" >> '+'./log/'+self.asdmname+'.analysis.v2.log')
+        FileOps.append_line('./log/'+self.asdmname+'.analysis.v2.log',content)
+
+    # checkpoint manifest: one record per step (or per field/spw substep of step5)
+    def load_checkpoint(self):
+        if os.path.exists(self.checkpointfile):
+            with open(self.checkpointfile,'r') as f:
+                return json.load(f)
+        return {'asdmname':self.asdmname,'tarfilename':self.tarfilename,'steps':{}}
+
+    def save_checkpoint(self):
+        os.makedirs(os.path.dirname(self.checkpointfile),exist_ok=True)
+        with open(self.checkpointfile+'.tmp','w') as f:
+            json.dump(self.checkpoint,f,indent=1,default=_jsonable)
+        os.replace(self.checkpointfile+'.tmp',self.checkpointfile)
+
+    def params_hash(self,params={}):
+        return hashlib.sha1(json.dumps(params,sort_keys=True,default=_jsonable).encode()).hexdigest()
+
+    # constructor options that change the products of a step (and of its substeps '5/<field>/...')
+    stepoptions = {
+        0:['onlyasdm','tarpolicy'],
+        5:['uvfitbackend','fusesplit','allspw','spacesave','memlimit','flagman'],
+        6:['allspw'],
+        7:['spacesave','tarpolicy'],
+        8:['plotformats'],
+        }
+
+    def step_params(self,key,params={}):
+        params = dict(params)
+        for k in self.stepoptions.get(int(str(key).split('/')[0]),[]):
+            params['self.'+k] = getattr(self,k)
+        return params
+
+    def checkpoint_done(self,key,params={}):
+        rec = self.checkpoint['steps'].get(str(key))
+        if not self.resume or rec == None:
+            return False
+        return rec['status'] == 'OK' and rec['params'] == self.params_hash(self.step_params(key,params)) and self.outputs_present(key,rec)
+
+    # the outputs of a skipped step must still be on disk, unless a later step is done (it has consumed
+    # them, spacesave may have removed them); paths are relative to the ASDM directory
+    def outputs_present(self,key,rec):
+        step = int(str(key).split('/')[0])
+        for (k,r) in self.checkpoint['steps'].items():
+            if int(k.split('/')[0]) > step and r['status'] == 'OK':
+                return True
+        missing = [path for path in rec['outputs'] if path != '' and not os.path.exists(os.path.join(self.asdmdir,path))]
+        if missing != []:
+            print(str(key)+': outputs missing ('+' '.join(missing)+'), rerun')
+            return False
+        return True
+
+    def checkpoint_mark(self,key,params={},inputs=[],outputs=[],status='OK',error=None):
+        state = {}
+        for k in self.statekeys:
+            if hasattr(self,k):
+                state[k] = getattr(self,k)
+
+        self.checkpoint['steps'][str(key)] = {
+            'status':status,
+            'params':self.params_hash(self.step_params(key,params)),
+            'inputs':inputs,
+            'outputs':outputs,
+            'state':state,
+            'error':error,
+            'completed':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+        self.save_checkpoint()
+
+    def checkpoint_clear(self,step):
+        # a rerun of step N invalidates N itself and everything downstream (substeps of N are kept)
+        # nothing to clear: no write, the manifest (and <asdm>/log) is created by the first finished step
+        cleared = False
+        for key in list(self.checkpoint['steps']):
+            keystep = int(key.split('/')[0])
+            if keystep > step or key == str(step):
+                del self.checkpoint['steps'][key]
+                cleared = True
+        if cleared:
+            self.save_checkpoint()
+
+    def restore_state(self,key):
+        for k,v in self.checkpoint['steps'][str(key)]['state'].items():
+            setattr(self,k,v)
+
+    def step_files(self,step):
+        visname = getattr(self,'visname','')
+        files = {
+            0:([self.tarfilename],[self.asdmdir]),
+            1:([getattr(self,'asdmfile','')],[visname]),
+            2:([visname],[visname+'.scriptForCalibration.py']),
+            3:([visname+'.org'],[visname]),
+            4:([visname+'.scriptForCalibration.py'],[visname+'.split']),
+            5:([visname+'.split'],['specdata','caltables']),
+            6:(['calibrated'],['imsg']),
+            7:(['calibrated'],['calibrated.tar.gz']),
+            8:(['specdata'],['specplot']),
+            }
+        return files.get(step,([],[]))
+
+    # run one step, or skip it when the manifest already has it with the same parameters
+    def runstep(self,step,func,**kwargs):
+        if self.checkpoint_done(step,kwargs):
+            self.restore_state(step)
+            if step == 0:
+                os.chdir(self.asdmdir)
+            print('step'+str(step)+': already done (checkpoint), skipped')
+            return
+
+        self.checkpoint_clear(step)
+        RunDB.report_step(self.tarfilename,str(step)+':'+func.__name__)
+        record = self.record_start(step,func.__name__)
+        try:
+            func(**kwargs)
+        except Exception as e:
+            self.record_end(record,status='failed',error=repr(e))
+            raise
+        self.record_end(record)
+        inputs,outputs = self.step_files(step)
+        self.checkpoint_mark(step,kwargs,inputs=inputs,outputs=outputs)
+
+    # step instrumentation: one json line per step (and per (field, spw) chain of step5) in log/<asdm>.steps.jsonl
+    # with wall/cpu time, peak RSS of this process and of its finished children (CASA tasks, uvmultifit),
+    # bytes written/deleted below the ASDM directory (disk=True) and the sizes of the MSes.
+    # ru_maxrss is a lifetime maximum: a step gets it only when it rose during the step (the new peak
+    # was reached there), otherwise null (the step stayed below an earlier peak)
+    def record_start(self,step,name='',disk=True):
+        import resource
+        record = {
+            'asdm':self.asdmname,
+            'step':str(step),
+            'name':name,
+            'pid':os.getpid(),
+            'start':time.time(),
+            'cpu_self':resource.getrusage(resource.RUSAGE_SELF),
+            'cpu_children':resource.getrusage(resource.RUSAGE_CHILDREN),
+            'files':None,
+            }
+        if disk:
+            record['files'] = file_sizes(self.asdmdir)
+        return record
+
+    def record_end(self,record,status='OK',error=None,ms=None):
+        import resource
+        ru_self = resource.getrusage(resource.RUSAGE_SELF)
+        ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        line = {
+            'asdm':record['asdm'],
+            'step':record['step'],
+            'name':record['name'],
+            'pid':record['pid'],
+            'status':status,
+            'error':error,
+            'start':record['start'],
+            'end':time.time(),
+            'wall':time.time()-record['start'],
+            'cpu_self':(ru_self.ru_utime+ru_self.ru_stime)-(record['cpu_self'].ru_utime+record['cpu_self'].ru_stime),
+            'cpu_children':(ru_children.ru_utime+ru_children.ru_stime)-(record['cpu_children'].ru_utime+record['cpu_children'].ru_stime),
+            # ru_maxrss is in KB on linux
+            'maxrss_self':step_maxrss(record['cpu_self'],ru_self),
+            'maxrss_children':step_maxrss(record['cpu_children'],ru_children),
+            }
+
+        if record['files'] != None:
+            files = file_sizes(self.asdmdir)
+            before = record['files']
+            line['disk_written'] = sum(max(0,size-before.get(path,0)) for (path,size) in files.items())
+            line['disk_deleted'] = sum(max(0,size-files.get(path,0)) for (path,size) in before.items())
+
+        if ms == None:
+            ms = glob.glob(os.path.join(self.asdmdir,'*.ms*'))+glob.glob(os.path.join(self.asdmdir,'calibrated','*'))
+        line['ms_sizes'] = dict([(os.path.basename(path),du(path)) for path in ms if os.path.isdir(path)])
+
+        os.makedirs(os.path.dirname(self.stepsfile),exist_ok=True)
+        with open(self.stepsfile,'a') as f:
+            f.write(json.dumps(line,default=_jsonable)+'\n')
+
+    # single streaming pass over a plain or compressed tarball
+    def extract_tar(self,tarfilename):
+        import tarfile
+
+        nmember = 0
+        with tarfile.open(tarfilename,'r|*') as tar:
+            for member in tar:
+                if self.onlyasdm and not ('/raw/' in member.name):
+                    continue
+                tar.extract(member,'.')
+                nmember = nmember + 1
+        print(tarfilename+': '+str(nmember)+' members extracted')
+
+        if self.tarpolicy == 'drop':
+            FileOps.rm_rf(tarfilename)
 
     # step0: untar & make working dir
     def intial_proc(self,forcerun=False,dryrun=False):
@@ -39,27 +571,27 @@ class QSOanalysis():
                 os.chdir(self.workingDir)
 
             if os.path.exists(self.tarfilename):
-                os.system('mkdir -p '+self.asdmname)
-                os.system('mv '+self.tarfilename+' '+self.asdmname+'/')
+                FileOps.mkdir_p(self.asdmname)
+                FileOps.mv(self.tarfilename,self.asdmname+'/')
                 os.chdir(self.asdmname)
-                os.system('tar -xvf '+self.tarfilename)
+                self.extract_tar(self.tarfilename)
 
             elif os.path.exists(self.tarfilename+'.gz'):
-                os.system('mkdir -p '+self.asdmname)
-                os.system('mv '+self.tarfilename+'.gz '+self.asdmname+'/')
+                FileOps.mkdir_p(self.asdmname)
+                FileOps.mv(self.tarfilename+'.gz',self.asdmname+'/')
                 os.chdir(self.asdmname)
-                os.system('gzip -d '+self.tarfilename+'.gz')
-                os.system('tar -xvf '+self.tarfilename)
+                self.extract_tar(self.tarfilename+'.gz')
 
-            elif os.path.exists(self.asdmname):
+            # an ASDM directory only counts with the tarball or the extracted data in it
+            elif os.path.exists(self.asdmname) and (glob.glob(os.path.join(self.asdmname,self.tarfilename+'*')) != [] or
+                                                    glob.glob(os.path.join(self.asdmname,self.projID)) + glob.glob(os.path.join(self.asdmname,'*.asdm.sdm')) != []):
                 os.chdir(self.asdmname)
 
                 if os.path.exists(self.tarfilename):
-                    os.system('tar -xvf '+self.tarfilename)
+                    self.extract_tar(self.tarfilename)
 
                 elif os.path.exists(self.tarfilename+'.gz'):
-                    os.system('gzip -d '+self.tarfilename+'.gz')
-                    os.system('tar -xvf '+self.tarfilename)
+                    self.extract_tar(self.tarfilename+'.gz')
 
             else:
                 print('Error: You may need to download data.')
@@ -72,7 +604,7 @@ class QSOanalysis():
 
         try:
             asdmfile = glob.glob('./' + self.projID + '/*/*/*/raw/*')[0]
-            os.system('ln -sf '+asdmfile+' .')
+            FileOps.symlink(asdmfile,'.')
             visname = (os.path.basename(asdmfile)).replace('.asdm.sdm','.ms')
         except:
             asdmfile = 'uid___' + self.tarfilename.split('_uid___')[1].replace('.tar','')
@@ -92,23 +624,23 @@ class QSOanalysis():
 
 
             from casatasks import importasdm
-            os.system('rm -rf '+kw_importasdm['vis'])
+            FileOps.rm_rf(kw_importasdm['vis'])
             importasdm(**kw_importasdm)
 
             try:
                 self.spws = aU.getScienceSpws(vis=visname).split(",")
-                os.system('mkdir -p tempfiles')
+                FileOps.mkdir_p('tempfiles')
                 np.save('tempfiles/spws.npy',np.array(self.spws))
 
             except:
-                self.spws = np.load('tempfiles/spws.npy')
+                self.spws = np.load('tempfiles/spws.npy').tolist()
 
         else:
             try:
-                self.spws = np.load('tempfiles/spws.npy')
+                self.spws = np.load('tempfiles/spws.npy').tolist()
             except:
                 self.spws = aU.getScienceSpws(vis=visname).split(",")
-                os.system('mkdir -p tempfiles')
+                FileOps.mkdir_p('tempfiles')
                 np.save('tempfiles/spws.npy',np.array(self.spws))
 
         self.asdmfile = asdmfile
@@ -130,12 +662,12 @@ class QSOanalysis():
 
         if not dryrun:
             if os.path.exists('./log/'+self.visname + '.scriptForCalibration.py'):
-                os.system('cp ./log/'+self.visname + '.scriptForCalibration.py ./')
+                FileOps.cp('./log/'+self.visname + '.scriptForCalibration.py','./')
 
             else:
                 csg.generateReducScript(**kw_generateReducScript)
-                os.system('mkdir -p ./log')
-                os.system('cp '+self.visname + '.scriptForCalibration.py ./log/')
+                FileOps.mkdir_p('./log')
+                FileOps.cp(self.visname + '.scriptForCalibration.py','./log/')
 
         self.refant = refant
         self.dish_diameter = aU.almaAntennaDiameter(refant[0])
@@ -155,8 +687,8 @@ class QSOanalysis():
 
             listOfIntents_init = (np.unique(IntentList)[np.unique(IntentList)!='OBSERVE_TARGET'])
 
-            os.system('rm -rf '+self.visname+'.org')
-            os.system('mv '+self.visname+' '+self.visname+'.org')
+            FileOps.rm_rf(self.visname+'.org')
+            FileOps.mv(self.visname,self.visname+'.org')
             kw_mstransform = {
                 'vis':self.visname+'.org',
                 'outputvis':self.visname,
@@ -166,8 +698,7 @@ class QSOanalysis():
                 }
 
             from casatasks import mstransform
-            os.system('rm -rf '+kw_mstransform['outputvis'])
-            os.system('rm -rf '+kw_mstransform['outputvis']+'.flagversions')
+            FileOps.rm_rf(kw_mstransform['outputvis'],kw_mstransform['outputvis']+'.flagversions')
             mstransform(**kw_mstransform)
 
         self.writelog('step3:OK')
@@ -217,33 +748,64 @@ class QSOanalysis():
 
         self.writelog('step4:OK')
 
+    # step4 of exec_analysis.py: calibration, then the intermediate MSes are dropped
+    def doCalib_spacesave(self,dryrun=False):
+        self.doCalib(dryrun=dryrun)
+        self.init_spacesave(dryrun=dryrun)
+
     def init_spacesave(self,dryrun=False):
 
         if not dryrun:
 
-            os.system('mkdir -p ./caltables')
-            os.system('mv '+self.visname+'.split.bandpass ./caltables/')
+            FileOps.mkdir_p('./caltables')
+            FileOps.mv(self.visname+'.split.bandpass','./caltables/')
             if self.spacesave:
-                os.system('rm -rf '+self.visname)
-                os.system('rm -rf '+self.visname+'.org')
-                os.system('rm -rf '+self.visname+'.flagversions')
-                os.system('rm -rf '+self.visname+'.tsys')
-                os.system('rm -rf '+self.visname+'.wvr*')
-                os.system('rm -rf '+self.visname+'.*.png')
-                os.system('rm -rf '+self.visname+'.split.*')
-                os.system('rm -rf *.asdm.sdm')
-                os.system('rm -rf '+self.projID)
+                FileOps.rm_rf(self.visname,self.visname+'.org',self.visname+'.flagversions',self.visname+'.tsys',self.visname+'.wvr*',
+                              self.visname+'.*.png',self.visname+'.split.*','*.asdm.sdm',self.projID)
+
+    def dolistobs(self,vis):
+        if self.listobs:
+            from casatasks import listobs
+            listobs(vis=vis,listfile=vis+'.listobs')
+
+    # step5-0: one pass over <vis>.split -> calibrator ON_SOURCE data of the science spws (corrected -> DATA)
+    def uvfit_splitCalibrators(self,dryrun=False):
+
+        kw_mstransform = {
+            'vis':self.visname+'.split',
+            'outputvis':'calibrated/'+self.visname+'.split.calibrators',
+            'datacolumn':'corrected',
+            'spw':','.join(self.spws),
+            'field':','.join(self.fields),
+            'intent':'*ON_SOURCE*',
+            'keepflags':False,
+            'reindex':False,
+            }
+
+        if not dryrun:
+            FileOps.mkdir_p('calibrated')
+            FileOps.rm_rf(kw_mstransform['outputvis'])
+
+            from casatasks import mstransform
+            mstransform(**kw_mstransform)
+
+    # input MS and column of the per-field/spw splits
+    def splitsource(self):
+        if self.fusesplit and os.path.exists('calibrated/'+self.visname+'.split.calibrators'):
+            return 'calibrated/'+self.visname+'.split.calibrators','data'
+        return self.visname+'.split','corrected'
 
     # step5-1: split calibrator observations
     def uvfit_splitQSO(self,spw,field,dryrun=False):
 
         self.spw = spw
         self.field = field
+        vis,datacolumn = self.splitsource()
 
         kw_mstransform = {
-            'vis':self.visname+'.split',
+            'vis':vis,
             'outputvis':'calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw,
-            'datacolumn':'corrected',
+            'datacolumn':datacolumn,
             'spw':spw,
             'field':field,
             'intent':'*ON_SOURCE*',
@@ -255,42 +817,91 @@ class QSOanalysis():
             }
 
         if not dryrun:
-            os.system('mkdir -p calibrated')
-            os.system('rm -rf '+kw_mstransform['outputvis'])
-            os.system('rm -rf '+kw_mstransform['outputvis']+'.listobs')
+            FileOps.mkdir_p('calibrated')
+            FileOps.rm_rf(kw_mstransform['outputvis'],kw_mstransform['outputvis']+'.listobs')
 
-            from casatasks import mstransform,listobs,delmod
+            from casatasks import mstransform,delmod
             mstransform(**kw_mstransform)
             delmod(vis=kw_mstransform['outputvis'],otf=True,scr=False)
-            listobs(vis=kw_mstransform['outputvis'],listfile=kw_mstransform['outputvis']+'.listobs')
+            self.dolistobs(kw_mstransform['outputvis'])
 
-    def avgspws(self,inputvis,dryrun=False):
+    # step5-allspw: inverse-variance weighted average of the single-channel .avg MSes of a field over spws,
+    # written to calibrated/<vis>.split.<field>.spw_all.avg (a copy of the first spw's MS: rows are matched
+    # to it by time and baseline, flagged where no spw has data, frequency = weighted mean of the spws)
+    def avgspws(self,field,mfsfit=True,dryrun=False):
+        self.field = field
+        self.spw = 'all.avg'
+        inputvis = [vis for vis in ['calibrated/'+self.visname+'.split.'+field+'.spw_'+spw+'.avg' for spw in self.spws] if os.path.exists(vis)]
+        outputvis = 'calibrated/'+self.visname+'.split.'+field+'.spw_'+self.spw
 
-        tb.open(inputvis)
-        sigma = tb.getcol('SIGMA')
-        data = tb.getcol('DATA')
-        ID = tb.getcol('DATA_DESC_ID')
-        spwIDs = np.unique(ID)
-        flag = tb.getcol('FLAG')
-        flag_new = np.zeros_like(flag[:,:,ID==0],dtype='bool')
+        if not dryrun:
+            if inputvis == []:
+                print('avgspws: no averaged MS for '+field)
+                return None
 
-        # new flag
-        for i in range(flag[0][0][ID1==0].shape[0]):
-            for ii in range(2):
-                tmp = False
-                for spwID in spwIDs:
-                    tmp = bool(tmp + (~flag)[ii][0][ID==spwID][i])
-                flag_new[ii][0][i] = not tmp
+            from casatools import table
+            tb = table()
+            FileOps.rm_rf(outputvis)
+            FileOps.cp(inputvis[0],outputvis)
 
-        # average
-        data_new = np.zeros_like(flag_new,dtype='float')
-        weight = np.zeros_like(flag_new,dtype='float')
-        for spwID in spwIDs:
-            data_new[:,0,:] = data_new[:,0,:] + data[:,0,ID==spwID]/sigma[:,ID==spwID]**2
-            weight[:,0,:] = weight[:,0,:] + 1./sigma[:,ID==spwID]**2
+            tb.open(outputvis)
+            base = baseline_keys(tb)
+            colnames = [col for col in ['DATA','CORRECTED_DATA','MODEL_DATA'] if col in tb.colnames()]
+            shape = tb.getcol('FLAG').shape
+            tb.close()
 
-        data_new = data_new/weight
+            wsum = np.zeros((shape[0],shape[2]))
+            wdata = dict([(col,np.zeros(shape,dtype='complex')) for col in colnames])
+            freqs = []
+            fweights = []
+            for vis in inputvis:
+                tb.open(vis)
+                idx = match_rows(base,baseline_keys(tb))
+                flag = tb.getcol('FLAG')
+                if flag.shape[:2] != shape[:2]:
+                    print('avgspws: '+vis+' has a different shape '+str(flag.shape[:2])+', skipped')
+                    tb.close()
+                    continue
+                w = np.where(flag[:,0,:],0.,tb.getcol('WEIGHT'))[:,idx >= 0]
+                wsum[:,idx[idx >= 0]] += w
+                for col in colnames:
+                    wdata[col][:,:,idx[idx >= 0]] += w[:,np.newaxis,:]*tb.getcol(col)[:,:,idx >= 0]
+                tb.close()
 
+                tb.open(vis+'/SPECTRAL_WINDOW')
+                freqs.append(tb.getcol('CHAN_FREQ')[:,0].mean())
+                tb.close()
+                fweights.append(w.sum())
+
+            tb.open(outputvis,nomodify=False)
+            good = (wsum > 0.)
+            for col in colnames:
+                with np.errstate(divide='ignore',invalid='ignore'):
+                    avg = wdata[col]/wsum[:,np.newaxis,:]
+                tb.putcol(col,np.where(good[:,np.newaxis,:],avg,0.))
+            tb.putcol('FLAG',np.repeat(~good[:,np.newaxis,:],shape[1],axis=1))
+            tb.putcol('WEIGHT',wsum)
+            with np.errstate(divide='ignore'):
+                tb.putcol('SIGMA',np.where(good,1./np.sqrt(wsum),0.))
+            if 'WEIGHT_SPECTRUM' in tb.colnames() and tb.iscelldefined('WEIGHT_SPECTRUM',0):
+                tb.putcol('WEIGHT_SPECTRUM',np.repeat(wsum[:,np.newaxis,:],shape[1],axis=1))
+            tb.flush()
+            tb.close()
+
+            if sum(fweights) > 0.:
+                freq = np.average(freqs,weights=fweights)
+                tb.open(outputvis+'/SPECTRAL_WINDOW',nomodify=False)
+                tb.putcol('CHAN_FREQ',np.zeros_like(tb.getcol('CHAN_FREQ'))+freq)
+                tb.putcol('REF_FREQUENCY',np.zeros_like(tb.getcol('REF_FREQUENCY'))+freq)
+                tb.flush()
+                tb.close()
+
+            print(outputvis+': '+str(len(inputvis))+' spws, '+'{:.1f}'.format(good.mean()*100.)+'% unflagged')
+
+        if mfsfit:
+            self.uvfit_uvmultifit(write='',column='data',intent='noselfcal',mfsfit=True,dryrun=dryrun)
+
+        return outputvis
 
     def uvfit_splitQSO_avg(self,spw,field,dryrun=False):
         self.spw = spw+'.avg'
@@ -299,12 +910,13 @@ class QSOanalysis():
         if not dryrun:
 
             from casatasks import split,listobs,mstransform,delmod
-            os.system('mkdir -p ./calibrated')
+            FileOps.mkdir_p('./calibrated')
+            vis,datacolumn = self.splitsource()
             #Nchans = [aU.getNChanFromCaltable(self.visname+'.split')[int(spw)] for spw in self.spws]
             kw_split = {
-                'vis':self.visname+'.split',
+                'vis':vis,
                 'outputvis':'calibrated/'+self.visname+'.split.'+field+'.spw_'+spw+'.avg',
-                'datacolumn':'corrected',
+                'datacolumn':datacolumn,
                 'spw':spw,
                 'width':aU.getNChanFromCaltable(self.visname+'.split')[int(spw)],
                 'field':field,
@@ -319,12 +931,10 @@ class QSOanalysis():
                 'keepflags':False,
                 }
 
-            os.system('rm -rf '+kw_split['outputvis'])
-            os.system('rm -rf '+kw_mstransform['outputvis'])
-            os.system('rm -rf '+kw_mstransform['outputvis']+'.listobs')
+            FileOps.rm_rf(kw_split['outputvis'],kw_mstransform['outputvis'],kw_mstransform['outputvis']+'.listobs')
             split(**kw_split)
             delmod(vis=kw_split['outputvis'],otf=True,scr=False)
-            listobs(vis=kw_split['outputvis'],listfile=kw_split['outputvis']+'.listobs')
+            self.dolistobs(kw_split['outputvis'])
             #mstransform(**kw_mstransform)
             #listobs(vis=kw_mstransform['outputvis'],listfile=kw_mstransform['outputvis']+'.listobs')
             #os.system('rm -rf '+kw_split['outputvis'])
@@ -341,12 +951,20 @@ class QSOanalysis():
             from casatasks import clearcal
             clearcal(**kw_clearcal)
 
+    # cores for one uvmultifit run: the cores of this process divided over the parallel uvfit chains
+    def uvfit_ncpu(self):
+        try:
+            ncores = len(os.sched_getaffinity(0))
+        except AttributeError:
+            ncores = os.cpu_count()
+        return max(1,ncores//max(1,self.uvfit_nproc))
+
     #step5-3: do uvmultifit
     def uvfit_uvmultifit(self,intent=None,write="",column='data',spwid='0',mfsfit=True,dryrun=False):
 
         if not dryrun:
-            os.system('mkdir -p tempfiles')
-            os.system('mkdir -p specdata')
+            FileOps.mkdir_p('tempfiles')
+            FileOps.mkdir_p('specdata')
 
             if intent == None:
                 outfile = self.visname+'.split.'+self.field+'.spw_'+self.spw+'.dat'
@@ -354,36 +972,88 @@ class QSOanalysis():
                 outfile = self.visname+'.split.'+self.field+'.spw_'+self.spw+'.'+intent+'.dat'
 
             #spws = ','.join(np.array(range(len(self.spws))).astype('<3U'))
-            f = open('./tempfiles/'+outfile.replace('.dat','.kw_uvfit.py'),'w')
-            f.write('from NordicARC import uvmultifit as uvm'+'\n')
-            f.write('\n')
-            f.write('kw_uvfit = {'+'\n')
-            f.write('   "vis":"'+'calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw+'",'+'\n')
-            f.write('   "spw":"0",'+'\n')
-            f.write('   "column":"'+column+'",'+'\n')
-            f.write('   "field":"0",'+'\n')
-            f.write('   "stokes":"I",'+'\n')
-            f.write('   "NCPU":8,'+'\n')
-            f.write('   "pbeam":True,'+'\n')
-            f.write('   "dish_diameter":'+str(self.dish_diameter)+','+'\n')
-            f.write('   "chanwidth":1,'+'\n')
-            f.write('   "var":["0,0,p[0]"],'+'\n')
-            f.write('   "p_ini":[10.0],'+'\n')
-            f.write('   "model":["delta"],'+'\n')
-            f.write('   "OneFitPerChannel":'+str((not mfsfit))+','+'\n')
-            f.write('   "write":"'+write+'",'+'\n')
-            f.write('   "method":"simplex",'+'\n')
-            f.write('   "bounds":[[0,None]],')
-            #f.write('   "SMPtune":[1.e-4,1.e-1,10000],')
-            f.write('   "outfile":"./specdata/'+outfile+'",'+'\n')
-            f.write('   }'+'\n')
-            f.write('myfit = uvm.uvmultifit(**kw_uvfit)'+'\n')
-            f.close()
+            kw_uvfit = {
+                'vis':'calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw,
+                'spw':'0',
+                'column':column,
+                'field':'0',
+                'stokes':'I',
+                'NCPU':self.uvfit_ncpu(),
+                'pbeam':True,
+                'dish_diameter':float(self.dish_diameter),
+                'chanwidth':1,
+                'var':['0,0,p[0]'],
+                'p_ini':[10.0],
+                'model':['delta'],
+                'OneFitPerChannel':(not mfsfit),
+                'write':write,
+                'method':'simplex',
+                'bounds':[[0,None]],
+                #'SMPtune':[1.e-4,1.e-1,10000],
+                'outfile':'./specdata/'+outfile,
+                }
+
+            if self.uvfitbackend == 'numpy':
+                self.uvfit_numpy(column=column,mfsfit=mfsfit,outfile=kw_uvfit['outfile'])
 
-            "'" + 'execfile("./tempfiles/'+outfile.replace('.dat','.kw_uvfit.py')+'")' + "'"
-            cmd = self.casacmdforuvfit+' --nologger --nogui --nologfile -c '+ "'" + 'execfile("./tempfiles/'+outfile.replace('.dat','.kw_uvfit.py')+'")' + "'"
-            os.system(cmd)
+            elif self.uvfitbackend == 'worker':
+                uvfitservice(self.casacmdforuvfit).fit(kw_uvfit)
+
+            elif self.uvfitbackend == 'inprocess':
+                from NordicARC import uvmultifit as uvm
+                uvm.uvmultifit(**kw_uvfit)
+
+            else:
+                f = open('./tempfiles/'+outfile.replace('.dat','.kw_uvfit.py'),'w')
+                f.write('from NordicARC import uvmultifit as uvm'+'\n')
+                f.write('\n')
+                f.write('kw_uvfit = '+repr(kw_uvfit)+'\n')
+                f.write('myfit = uvm.uvmultifit(**kw_uvfit)'+'\n')
+                f.close()
+
+                cmd = self.casacmdforuvfit+' --nologger --nogui --nologfile -c '+ "'" + 'execfile("./tempfiles/'+outfile.replace('.dat','.kw_uvfit.py')+'")' + "'"
+                os.system(cmd)
+
+
+    # numpy alternative of uvfit_uvmultifit for the delta model at the phase centre
+    # (the primary beam response there is 1, so pbeam correction does not change the flux)
+    def uvfit_numpy(self,column='data',mfsfit=True,outfile=''):
+        from casatools import table
+        tb = table()
+        vis = 'calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw
+
+        tb.open(vis+'/SPECTRAL_WINDOW')
+        freq = tb.getcol('CHAN_FREQ')[:,0]
+        tb.close()
+
+        tb.open(vis)
+        colname = {'data':'DATA','corrected':'CORRECTED_DATA'}[column]
+        weightcol = 'WEIGHT'
+        if 'WEIGHT_SPECTRUM' in tb.colnames() and tb.nrows() > 0 and tb.iscelldefined('WEIGHT_SPECTRUM',0):
+            weightcol = 'WEIGHT_SPECTRUM'
+
+        chunksize = row_chunksize(tb,[colname,weightcol,'FLAG'],self.memlimit)
+        sums = None
+        for start in range(0,tb.nrows(),chunksize):
+            nrow = min(chunksize,tb.nrows()-start)
+            sums = add_sums(sums,pointsource_sums(tb.getcol(colname,start,nrow),tb.getcol(weightcol,start,nrow),tb.getcol('FLAG',start,nrow),mfs=mfsfit))
+        tb.close()
+
+        if sums == None:
+            # empty MS: NaN result line(s) instead of a fit
+            print('uvfit_numpy: no rows in '+vis)
+            nan = np.full(1 if mfsfit else freq.shape[0],np.nan)
+            flux,err,redchi2 = nan,nan,nan
+        else:
+            flux,err,redchi2 = pointsource_fit(sums)
+        if mfsfit:
+            freq = np.array([freq.mean()])
+            flux,err,redchi2 = np.atleast_1d(flux),np.atleast_1d(err),np.atleast_1d(redchi2)
 
+        header = 'MODELFITTING RESULTS FOR MS: '+vis+'\n'
+        header = header + 'MODEL: delta at phase centre, fitted with QSOanalysis.uvfit_numpy ('+column+' column)\n'
+        header = header + 'Frequency (Hz)     p[0]     error(p[0])     red. ChiSq'
+        np.savetxt(outfile,np.array([freq,flux,err,redchi2]).T,header=header)
 
     # step5-4: gaincal
     def uvfit_gaincal(self,intent='phase',solint='int',solnorm=False,gaintype='G',calmode='p',gaintable='',dryrun=False):
@@ -402,8 +1072,8 @@ class QSOanalysis():
             }
 
         if not dryrun:
-            os.system('mkdir -p caltables')
-            os.system('rm -rf '+kw_gaincal['caltable'])
+            FileOps.mkdir_p('caltables')
+            FileOps.rm_rf(kw_gaincal['caltable'])
 
             from casatasks import gaincal
             gaincal(**kw_gaincal)
@@ -435,202 +1105,150 @@ class QSOanalysis():
                     'keepflags':False,
                     }
 
-                from casatasks import mstransform, listobs
-                os.system('mv '+kw_applycal['vis']+' '+kw_mstransform['vis'])
-                os.system('rm -rf '+kw_mstransform['outputvis']+'.listobs')
+                from casatasks import mstransform
+                FileOps.mv(kw_applycal['vis'],kw_mstransform['vis'])
+                FileOps.rm_rf(kw_mstransform['outputvis']+'.listobs')
                 mstransform(**kw_mstransform)
-                os.system('rm -rf '+kw_mstransform['vis'])
-                listobs(vis=kw_mstransform['outputvis'],listfile=kw_mstransform['outputvis']+'.listobs')
+                FileOps.rm_rf(kw_mstransform['vis'])
+                self.dolistobs(kw_mstransform['outputvis'])
 
 
 
 
     # step5-6: gainplot
-    def uvfit_gainplot(self,type='amp_phase',dryrun=False,allspws=False):
+    # every caltable is read once for all types; per-file plots (formats, e.g. ['png'] or ['png','pdf'])
+    # are rendered on nproc spawned workers, 'multipdf' in formats collects all of them into
+    # caltables/<asdm>.gainplot.pdf instead of one pdf per plot
+    def uvfit_gainplot(self,types=['phase','amp_phase'],dryrun=False,allspws=False,formats=None,nproc=None):
 
         if not dryrun:
             from casatools import table
             tb = table()
-            import matplotlib.pyplot as plt
-
-            if allspws:
-                for field in self.fields:
-                    for spw in self.spws:
-                    #spw = 'all'
-
-                        caltablebase = self.asdmname+'.ms.split.'+field+'.spw_'+spw+'.avg'
-                        caltable0 = './caltables/' + caltablebase + '.'+type+'_0'
-                        caltable1 = './caltables/' + caltablebase + '.'+type+'_1'
-
-                        tb.open(caltable0)
-                        Time0  = tb.getcol('TIME').copy()
-                        cgain0 = tb.getcol('CPARAM').copy()
-                        ant0   = tb.getcol('ANTENNA1') .copy()
-                        tb.close()
-
-                        tb.open(caltable1)
-                        Time1  = tb.getcol('TIME').copy()
-                        cgain1 = tb.getcol('CPARAM').copy()
-                        ant1   = tb.getcol('ANTENNA1') .copy()
-                        tb.close()
-
-                        if type == 'phase':
-                            phase0_0 = np.angle(cgain0[0][0],deg=True)
-                            phase0_1 = np.angle(cgain0[1][0],deg=True)
-                            phase1   = np.angle(cgain1[0][0],deg=True)
-                        elif type == 'amp_phase':
-                            phase0_0 = np.abs(cgain0[0][0])
-                            phase1   = np.abs(cgain1[0][0])
-
-
-                        plt.close()
-                        titlename = self.asdmname+' '+field+' spw:'+spw
-                        plt.title(titlename)
-                        plt.scatter((Time0-Time0[0])/60.,phase0_0,c='b',s=2)
-                        if type == 'phase':
-                            plt.scatter((Time0-Time0[0])/60.,phase0_1,c='b',s=2)
-                        plt.scatter((Time1-Time1[0])/60.,phase1,c='r',s=1)
-                        plt.xlabel('Time from the first integration [min]')
-                        if type == 'phase':
-                            plt.ylabel('Gain phase [deg]')
-                        elif type == 'amp_phase':
-                            plt.ylabel('Gain amplitude')
-                        plt.savefig('./caltables/'+caltablebase+'.gainplot.'+type+'.png')
-                        plt.savefig('./caltables/'+caltablebase+'.gainplot.'+type+'.pdf')
-                        plt.close()
 
-            else:
+            if isinstance(types,str):
+                types = [types]
+            if formats == None:
+                formats = self.plotformats
+            multipdf = ('multipdf' in formats)
+            formats = [fmt for fmt in formats if fmt != 'multipdf']
+
+            plots = []
+            for field in self.fields:
+                for spw in self.spws:
+                    caltablebase = self.asdmname+'.ms.split.'+field+'.spw_'+spw
+                    if allspws:
+                        caltablebase = caltablebase+'.avg'
+
+                    for type in types:
+                        cal = {}
+                        for n in ['0','1']:
+                            caltable = './caltables/'+caltablebase+'.'+type+'_'+n
+                            if not os.path.exists(caltable):
+                                print('gainplot: '+caltable+' not found, skipped')
+                                break
+                            tb.open(caltable)
+                            cal[n] = (tb.getcol('TIME'),tb.getcol('CPARAM')[:,0,:])
+                            tb.close()
+                        if len(cal) < 2:
+                            continue
+
+                        plots.append({
+                            'title':self.asdmname+' '+field+' spw:'+spw,
+                            'type':type,
+                            'time0':cal['0'][0],
+                            'gain0':cal['0'][1][:2],
+                            'time1':cal['1'][0],
+                            'gain1':cal['1'][1][:1],
+                            'outbase':'./caltables/'+caltablebase+'.gainplot.'+type,
+                            })
+
+            if formats != [] and plots != []:
+                if nproc == None:
+                    nproc = self.uvfit_ncpu()*max(1,self.uvfit_nproc)
+                if nproc > 1 and len(plots) > 1:
+                    import multiprocessing
+                    from concurrent.futures import ProcessPoolExecutor
+                    with ProcessPoolExecutor(max_workers=min(nproc,len(plots)),mp_context=multiprocessing.get_context('spawn')) as executor:
+                        list(executor.map(render_gainplot,plots,[formats]*len(plots)))
+                else:
+                    for plot in plots:
+                        render_gainplot(plot,formats)
 
-                for field in self.fields:
-                    for spw in self.spws:
-                        caltablebase = self.asdmname+'.ms.split.'+field+'.spw_'+spw
-                        caltable0 = './caltables/' + caltablebase + '.'+type+'_0'
-                        caltable1 = './caltables/' + caltablebase + '.'+type+'_1'
-
-                        tb.open(caltable0)
-                        Time0  = tb.getcol('TIME').copy()
-                        cgain0 = tb.getcol('CPARAM').copy()
-                        ant0   = tb.getcol('ANTENNA1') .copy()
-                        tb.close()
-
-                        tb.open(caltable1)
-                        Time1  = tb.getcol('TIME').copy()
-                        cgain1 = tb.getcol('CPARAM').copy()
-                        ant1   = tb.getcol('ANTENNA1') .copy()
-                        tb.close()
-
-                        if type == 'phase':
-                            phase0_0 = np.angle(cgain0[0][0],deg=True)
-                            phase0_1 = np.angle(cgain0[1][0],deg=True)
-                            phase1   = np.angle(cgain1[0][0],deg=True)
-                        elif type == 'amp_phase':
-                            phase0_0 = np.abs(cgain0[0][0])
-                            phase1   = np.abs(cgain1[0][0])
-
-
-                        plt.close()
-                        titlename = self.asdmname+' '+field+' spw:'+spw
-                        plt.title(titlename)
-                        plt.scatter((Time0-Time0[0])/60.,phase0_0,c='b',s=2)
-                        if type == 'phase':
-                            plt.scatter((Time0-Time0[0])/60.,phase0_1,c='b',s=2)
-                        plt.scatter((Time1-Time1[0])/60.,phase1,c='r',s=1)
-                        plt.xlabel('Time from the first integration [min]')
-                        if type == 'phase':
-                            plt.ylabel('Gain phase [deg]')
-                        elif type == 'amp_phase':
-                            plt.ylabel('Gain amplitude')
-                        plt.savefig('./caltables/'+caltablebase+'.gainplot.'+type+'.png')
-                        plt.savefig('./caltables/'+caltablebase+'.gainplot.'+type+'.pdf')
-                        plt.close()
+            if multipdf and plots != []:
+                from matplotlib.backends.backend_pdf import PdfPages
+                with PdfPages('./caltables/'+self.asdmname+'.gainplot.pdf') as pdf:
+                    for plot in plots:
+                        pdf.savefig(gainplot_figure(plot))
 
     # step5-7: uvfitting
     def uvfit_man(self,datacolumn='data',intent=None,write_residuals=False,savemodel=False,dryrun=False,meansub=False,oldmode=True):
 
         if not dryrun:
-            if not oldmode:
+            from casatools import table
+            tb = table()
+            vis = 'calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw
+            colname = {'data':'DATA','corrected':'CORRECTED_DATA'}[datacolumn]
 
-                from casatools import table
-                from scipy.optimize import least_squares
-                tb = table()
-                tb.open('calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw)
-                if datacolumn == 'data':
-                    data = tb.getcol('DATA').copy()
-                elif datacolumn == 'corrected':
-                    data = tb.getcol('CORRECTED_DATA').copy()
-                flag = tb.getcol('FLAG').copy()
-                weight = tb.getcol('WEIGHT').copy().reshape([2,1,flag.shape[2]])
+            if not oldmode:
+                # weighted mean of the visibilities, accumulated over row chunks
+                tb.open(vis)
+                chunksize = row_chunksize(tb,[colname,'WEIGHT','FLAG'],self.memlimit)
+                sums = None
+                for start in range(0,tb.nrows(),chunksize):
+                    n = min(chunksize,tb.nrows()-start)
+                    sums = add_sums(sums,pointsource_sums(tb.getcol(colname,start,n),tb.getcol('WEIGHT',start,n),tb.getcol('FLAG',start,n),mfs=True))
                 tb.close()
+                if sums == None:
+                    print('uvfit_man: no rows in '+vis)
+                    return
 
-                def res_func(param,x,y):
-                    res = (y- (param[0] + 0.*1j))**2*weight
-                    return np.abs(res)[~flag]
-
-                res = least_squares(res_func,[1.0],args=(np.zeros_like(data),data))
+                spec = np.atleast_1d(pointsource_fit(sums)[0])
                 print('### fit ###')
-                print(res.x[0])
-
-                model = np.zeros_like(data,dtype='complex')
-                spec = np.zeros(1) + res.x[0]
-
-                for i in range(data.shape[2]):
-                    model[0,:,i] = model[0,:,i] + spec.astype('complex')
-                    model[1,:,i] = model[1,:,i] + spec.astype('complex')
-
-                tb.open('calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw,nomodify=False)
-                if savemodel:
-                    tb.putcol('MODEL_DATA',model.copy())
-
-                if write_residuals:
-                    new_corr = (data.copy() - model.copy())
-                    tb.putcol('CORRECTED_DATA', new_corr)
-
-
-                tb.flush()
-                tb.close()
+                print(spec[0])
 
             else:
-                from casatools import table
-                from scipy.optimize import least_squares
-                tb = table()
-
                 if intent == None:
                     infile = './specdata/'+self.visname+'.split.'+self.field+'.spw_'+self.spw+'.dat'
                 else:
                     infile = './specdata/'+self.visname+'.split.'+self.field+'.spw_'+self.spw+'.'+intent+'.dat'
 
-
-                # spec
-                tb.open('calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw)
-                data  = tb.getcol('DATA')
-                model = np.zeros_like(data,dtype='complex')
+                # spec: one flux (mfs fit) or one per channel
                 modeldata = np.loadtxt(infile)
-                spec = np.zeros(1) + modeldata[1]
+                if modeldata.ndim == 1:
+                    spec = np.atleast_1d(modeldata[1])
+                else:
+                    spec = modeldata[:,1]
 
+            if not (savemodel or write_residuals):
+                return
 
-                for i in range(data.shape[2]):
-                    model[0,:,i] = model[0,:,i] + spec.astype('complex')
-                    model[1,:,i] = model[1,:,i] + spec.astype('complex')
+            # point source model on the parallel hands, broadcast over rows
+            tb.open(vis,nomodify=False)
+            chunksize = row_chunksize(tb,[colname],self.memlimit,copies=3)
+            for start in range(0,tb.nrows(),chunksize):
+                n = min(chunksize,tb.nrows()-start)
+                if write_residuals:
+                    data = tb.getcol(colname,start,n)
+                    shape = data.shape
+                else:
+                    shape = tb.getcell(colname,start).shape+(n,)
+                model = np.zeros(shape,dtype='complex')
+                model[parallel_hands(shape[0])] = spec[:,np.newaxis]
 
-                tb.close()
-                tb.open('calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw,nomodify=False)
                 if savemodel:
-                    tb.putcol('MODEL_DATA',model.copy())
-
+                    tb.putcol('MODEL_DATA',model,start,n)
                 if write_residuals:
-                    if datacolumn == 'data':
-                        res = data.copy() - model.copy()
-                    elif datacolumn == 'corrected':
-                        corr_data = tb.getcol('CORRECTED_DATA')
-                        res = corr_data.copy() - model.copy()
-                    tb.putcol('CORRECTED_DATA', res)
+                    data -= model
+                    tb.putcol('CORRECTED_DATA',data,start,n)
 
-
-                tb.flush()
-                tb.close()
+            tb.flush()
+            tb.close()
 
 
     # manural flagging
+    # per channel, integrations with a flagged or >nsigma visibility (parallel hands) in any row are
+    # flagged for all rows and pols of the same time; an edge channel flagged throughout only stays
+    # flagged itself. The table is read in row chunks, returns the flagged fraction
     def uvfit_flag_man(self,intent=None,nsigma=10.,dryrun=False):
 
         if not dryrun:
@@ -644,76 +1262,156 @@ class QSOanalysis():
 
             vis = 'calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw
 
-            tb.open(vis)
-            corr_data = tb.getcol('CORRECTED_DATA')
-            Time = tb.getcol('TIME')
-            flag = tb.getcol('FLAG')
-            ndata = corr_data.shape[0]*corr_data.shape[2]
             fitdata = np.loadtxt(infile)
-            threshold = nsigma * fitdata[2] * (ndata)**0.5
-            flagsigma = (np.abs(corr_data) > threshold)
-            flag_new = flag + flagsigma
-            tb.close()
+            if fitdata.ndim == 1:
+                error = fitdata[2]
+            else:
+                error = fitdata[:,2][np.newaxis,:,np.newaxis]
 
-            Time_flag = Time[(flag_new[0][0] + flag_new[1][0])]
-            flag_res = np.zeros_like(flag_new,dtype='bool')
-            for i in range(Time.shape[0]):
-                if Time[i] in Time_flag:
-                    flag_res[0][0][i] = True
-                    flag_res[1][0][i] = True
-                else:
-                    flag_res[0][0][i] = False
-                    flag_res[1][0][i] = False
+            tb.open(vis)
+            nrow = tb.nrows()
+            if nrow == 0:
+                tb.close()
+                return 0.
+            npol,nchan = tb.getcell('FLAG',0).shape
+            pol = parallel_hands(npol)
+            ndata = len(pol)*nrow
+            threshold = nsigma * error * (ndata)**0.5
+            chunksize = row_chunksize(tb,['CORRECTED_DATA','FLAG','TIME'],self.memlimit,copies=4)
+
+            # flagged (time, channel) pairs as keys time index x nchan + channel
+            Times = np.unique(tb.getcol('TIME'))
+            keys_flag = []
+            for start in range(0,nrow,chunksize):
+                n = min(chunksize,nrow-start)
+                corr_data = tb.getcol('CORRECTED_DATA',start,n)[pol]
+                flag = tb.getcol('FLAG',start,n)[pol]
+                itime = np.searchsorted(Times,tb.getcol('TIME',start,n))
+                bad = (flag | (np.abs(corr_data) > threshold)).any(axis=0)
+                chan,row = np.nonzero(bad)
+                keys_flag.append(np.unique(itime[row]*nchan+chan))
+            keys_flag = np.unique(np.concatenate(keys_flag))
+            tb.close()
 
+            nflag = 0
+            ntotal = 0
             tb.open(vis,nomodify=False)
-            tb.putcol('FLAG',flag_res)
+            for start in range(0,nrow,chunksize):
+                n = min(chunksize,nrow-start)
+                itime = np.searchsorted(Times,tb.getcol('TIME',start,n))
+                keys = itime[np.newaxis,:]*nchan+np.arange(nchan)[:,np.newaxis]
+                flag_res = np.ascontiguousarray(np.broadcast_to(np.isin(keys,keys_flag),(npol,nchan,n)))
+                tb.putcol('FLAG',flag_res,start,n)
+                nflag = nflag + flag_res.sum()
+                ntotal = ntotal + flag_res.size
             tb.flush()
             tb.close()
 
+            fraction = float(nflag)/ntotal
+            print(vis+': '+'{:.2f}'.format(fraction*100.)+'% flagged ('+str(len(keys_flag))+' integration x channel)')
+            return fraction
+
 
     # step5: uvmultifit & selfcal
     def uvfit_run(self,dryrun=False,plot=True):
 
+        todo = [(_field,_spw) for _field in self.fields for _spw in self.spws if not self.checkpoint_done('5/'+_field+'/spw_'+_spw,{'dryrun':dryrun})]
+        if self.fusesplit and todo != []:
+            self.uvfit_splitCalibrators(dryrun=dryrun)
+
+        # pairs are independent after doCalib: run them serially or in parallel CASA processes,
+        # results (and checkpoint records) are merged back here as each one finishes
         for _field in self.fields:
             for _spw in self.spws:
-                # selfcal by avaraged MS
-
-                self.uvfit_splitQSO_avg(spw=_spw,field=_field,dryrun=dryrun)
-                self.uvfit_createcol(dryrun=dryrun)
-                self.uvfit_uvmultifit(write='',column='data',dryrun=dryrun,mfsfit=True,intent='noselfcal')
-                self.uvfit_man(datacolumn='data',write_residuals=False,savemodel=True,intent='noselfcal',dryrun=dryrun,meansub=False)
+                if not (_field,_spw) in todo:
+                    print('5/'+_field+'/spw_'+_spw+': already done (checkpoint), skipped')
+
+        if self.uvfit_nproc > 1 and len(todo) > 1:
+            from concurrent.futures import ThreadPoolExecutor, as_completed
+            executor = ThreadPoolExecutor(max_workers=min(self.uvfit_nproc,len(todo)),thread_name_prefix="uvfit")
+            results = as_completed([executor.submit(uvfit_unit_process,self,_field,_spw,dryrun) for (_field,_spw) in todo])
+            results = (future.result() for future in results)
+        else:
+            executor = None
+            results = (uvfit_unit(self,_field,_spw,dryrun) for (_field,_spw) in todo)
+
+        failed = []
+        for result in results:
+            if result['status'] != 'OK':
+                print('ERROR: '+result['key']+' -> '+result['error'])
+                failed.append(result['key'])
+                self.checkpoint_mark(result['key'],{'dryrun':dryrun},status='failed',error=result['error'])
+            else:
+                self.checkpoint_mark(result['key'],{'dryrun':dryrun},inputs=[self.visname+'.split'],outputs=result['outputs'])
 
-                gaintable_p  = self.uvfit_gaincal(intent='phase_0',solint='int',gaintype='G',calmode='p',gaintable='',dryrun=dryrun)
-                gaintable_ap = self.uvfit_gaincal(intent='amp_phase_0',solint='int',solnorm=True,gaintype='T',calmode='ap',gaintable=[gaintable_p],dryrun=dryrun)
-                self.uvfit_applycal(gaintable=[gaintable_p,gaintable_ap],dryrun=dryrun,removeflag=False)
+        if executor != None:
+            executor.shutdown()
 
-                self.uvfit_uvmultifit(write='',column='corrected',intent='selfcal',dryrun=dryrun,mfsfit=True)
-                self.uvfit_man(datacolumn='corrected',write_residuals=True,savemodel=True,intent='selfcal',dryrun=dryrun,meansub=False)
+        if self.fusesplit and not dryrun:
+            FileOps.rm_rf('calibrated/'+self.visname+'.split.calibrators')
 
-                gaintable_p1  = self.uvfit_gaincal(intent='phase_1',solint='int',gaintype='T',calmode='p',gaintable=[gaintable_p,gaintable_ap],dryrun=dryrun)
-                gaintable_ap1 = self.uvfit_gaincal(intent='amp_phase_1',solint='int',solnorm=True,gaintype='T',calmode='ap',gaintable=[gaintable_p,gaintable_ap,gaintable_p1],dryrun=dryrun)
+        if failed != []:
+            stop_uvfitservices()
+            self.writelog('step5:Partially failed '+' '.join(failed))
+            raise RuntimeError('uvfit failed for '+' '.join(failed))
 
-                self.uvfit_splitQSO(spw=_spw,field=_field,dryrun=dryrun)
-                self.uvfit_uvmultifit(write='',column='data',intent='noselfcal',dryrun=dryrun,mfsfit=False)
-                self.uvfit_applycal(gaintable=[gaintable_p,gaintable_ap,gaintable_p1,gaintable_ap1],dryrun=dryrun)
-                self.uvfit_uvmultifit(write='',column='corrected',intent='selfcal',dryrun=dryrun,mfsfit=False)
-                if self.spacesave:
-                    os.system('rm -rf calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw)
-                    os.system('rm -rf calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw+'.listobs')
+        if self.allspw:
+            for _field in self.fields:
+                if not self.checkpoint_done('5/'+_field+'/allspw',{'dryrun':dryrun}):
+                    self.avgspws(_field,dryrun=dryrun)
+                    outputs = glob.glob('./specdata/'+self.visname+'.split.'+_field+'.spw_all.avg*.dat')
+                    self.checkpoint_mark('5/'+_field+'/allspw',{'dryrun':dryrun},inputs=[self.visname+'.split'],outputs=outputs)
+        # after the allspw fits, which use the same uvfit services
+        stop_uvfitservices()
 
-        self.uvfit_gainplot(dryrun=(not plot),allspws=True,type='phase')
-        self.uvfit_gainplot(dryrun=(not plot),allspws=True,type='amp_phase')
+        self.uvfit_gainplot(dryrun=(not plot),allspws=True,types=['phase','amp_phase'])
 
         self.writelog('step5:OK')
 
+    # step5: selfcal & fitting chain for one (field, spw)
+    # uses self.field/self.spw as working state, run it through uvfit_unit on a copy
+    def uvfit_chain(self,_field,_spw,dryrun=False):
+        # selfcal by avaraged MS
+        self.uvfit_splitQSO_avg(spw=_spw,field=_field,dryrun=dryrun)
+        self.uvfit_createcol(dryrun=dryrun)
+        self.uvfit_uvmultifit(write='',column='data',dryrun=dryrun,mfsfit=True,intent='noselfcal')
+        self.uvfit_man(datacolumn='data',write_residuals=False,savemodel=True,intent='noselfcal',dryrun=dryrun,meansub=False)
+
+        gaintable_p  = self.uvfit_gaincal(intent='phase_0',solint='int',gaintype='G',calmode='p',gaintable='',dryrun=dryrun)
+        gaintable_ap = self.uvfit_gaincal(intent='amp_phase_0',solint='int',solnorm=True,gaintype='T',calmode='ap',gaintable=[gaintable_p],dryrun=dryrun)
+        self.uvfit_applycal(gaintable=[gaintable_p,gaintable_ap],dryrun=dryrun,removeflag=False)
+
+        self.uvfit_uvmultifit(write='',column='corrected',intent='selfcal',dryrun=dryrun,mfsfit=True)
+        self.uvfit_man(datacolumn='corrected',write_residuals=True,savemodel=True,intent='selfcal',dryrun=dryrun,meansub=False)
+        if self.flagman:
+            self.uvfit_flag_man(intent='selfcal',dryrun=dryrun)
+
+        gaintable_p1  = self.uvfit_gaincal(intent='phase_1',solint='int',gaintype='T',calmode='p',gaintable=[gaintable_p,gaintable_ap],dryrun=dryrun)
+        gaintable_ap1 = self.uvfit_gaincal(intent='amp_phase_1',solint='int',solnorm=True,gaintype='T',calmode='ap',gaintable=[gaintable_p,gaintable_ap,gaintable_p1],dryrun=dryrun)
+
+        self.uvfit_splitQSO(spw=_spw,field=_field,dryrun=dryrun)
+        self.uvfit_uvmultifit(write='',column='data',intent='noselfcal',dryrun=dryrun,mfsfit=False)
+        self.uvfit_applycal(gaintable=[gaintable_p,gaintable_ap,gaintable_p1,gaintable_ap1],dryrun=dryrun)
+        self.uvfit_uvmultifit(write='',column='corrected',intent='selfcal',dryrun=dryrun,mfsfit=False)
+        if self.spacesave:
+            FileOps.rm_rf('calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw,'calibrated/'+self.visname+'.split.'+self.field+'.spw_'+self.spw+'.listobs')
+
     # step6: continuum imaging
-    def cont_imaging(self,clean=False,dryrun=False):
+    # allspw: image the spw-combined MS of avgspws instead of the per-spw .avg MSes (default: self.allspw)
+    def cont_imaging(self,clean=False,allspw=None,dryrun=False):
+
+        if allspw == None:
+            allspw = self.allspw
 
         if not dryrun:
 
             for field in self.fields:
-                os.system('rm -rf '+'./calibrated/concat.'+field+'.ms')
-                visForimsg = glob.glob('./calibrated/'+self.visname+'.split.'+field+'.spw_*.avg')
+                FileOps.rm_rf('./calibrated/concat.'+field+'.ms')
+                allspwvis = './calibrated/'+self.visname+'.split.'+field+'.spw_all.avg'
+                if allspw and os.path.exists(allspwvis):
+                    visForimsg = [allspwvis]
+                else:
+                    visForimsg = [vis for vis in glob.glob('./calibrated/'+self.visname+'.split.'+field+'.spw_*.avg') if vis != allspwvis]
 
                 kw_tclean = {
                     'vis':visForimsg,
@@ -734,8 +1432,8 @@ class QSOanalysis():
                     'restoringbeam':'common',
                     }
 
-                os.system('mkdir -p imsg')
-                os.system('rm -rf '+kw_tclean['imagename']+'*')
+                FileOps.mkdir_p('imsg')
+                FileOps.rm_rf(kw_tclean['imagename']+'*')
                 from casatasks import tclean, exportfits
                 tclean(**kw_tclean)
                 exportfits(kw_tclean['imagename']+'.image',kw_tclean['imagename']+'.image.fits')
@@ -743,8 +1441,7 @@ class QSOanalysis():
                 exportfits(kw_tclean['imagename']+'.psf',kw_tclean['imagename']+'.psf.fits')
 
 
-                for ext in ['.image','.mask','.model','.image.pbcor','.residual','.psf','.pb','.sumwt']:
-                    os.system('rm -rf '+kw_tclean['imagename']+ext)
+                FileOps.rm_rf(*[kw_tclean['imagename']+ext for ext in ['.image','.mask','.model','.image.pbcor','.residual','.psf','.pb','.sumwt']])
 
                 if clean:
                     from casatasks import imstat
@@ -769,8 +1466,8 @@ class QSOanalysis():
                         'restoringbeam':'common',
                         }
 
-                    os.system('mkdir -p imsg')
-                    os.system('rm -rf '+kw_tclean['imagename']+'*')
+                    FileOps.mkdir_p('imsg')
+                    FileOps.rm_rf(kw_tclean['imagename']+'*')
                     from casatasks import tclean, exportfits
                     tclean(**kw_tclean)
                     exportfits(kw_tclean['imagename']+'.image',kw_tclean['imagename']+'.image.fits')
@@ -778,8 +1475,7 @@ class QSOanalysis():
                     exportfits(kw_tclean['imagename']+'.psf',kw_tclean['imagename']+'.psf.fits')
 
 
-                    for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt']:
-                        os.system('rm -rf '+kw_tclean['imagename']+ext)
+                    FileOps.rm_rf(*[kw_tclean['imagename']+ext for ext in ['.image','.mask','.model','.image.pbcor','.psf','.residual','.pb','.sumwt']])
 
         self.writelog('step6:OK')
 
@@ -788,9 +1484,11 @@ class QSOanalysis():
 
         if not dryrun:
             if self.spacesave:
-                from casatasks import mstransform,listobs
+                from casatasks import mstransform
                 for field in  self.fields:
-                    for spw in self.spws:
+                    # spw_all.avg: spw-combined MS of avgspws (allspw)
+                    spws = list(self.spws) + [spw for spw in ['all'] if os.path.exists('calibrated/'+self.visname+'.split.'+field+'.spw_all.avg')]
+                    for spw in spws:
                         kw_mstransform = {
                             'vis':'calibrated/'+self.visname+'.split.'+field+'.spw_'+spw+'.avg',
                             'outputvis':'calibrated/'+self.visname+'.split.'+field+'.spw_'+spw+'.avg'+'.selfcal.residual',
@@ -798,99 +1496,126 @@ class QSOanalysis():
                             'keepflags':True
                             }
 
-                        os.system('rm -rf '+kw_mstransform['outputvis'])
+                        FileOps.rm_rf(kw_mstransform['outputvis'])
                         mstransform(**kw_mstransform)
-                        listobs(vis=kw_mstransform['outputvis'],listfile=kw_mstransform['outputvis']+'.listobs')
-                        os.system('rm -rf '+kw_mstransform['vis'])
-                        os.system('rm -rf '+kw_mstransform['vis']+'.listobs')
-
-                try:
-                    os.system('mkdir -p log')
-                    os.system('mv ./casa-*.log ./log/')
-                    os.system('cp ./calibrated/*.listobs ./log/')
-                except:
-                    print('ERRPR: copy casalog failed')
-
-                try:
-                    os.system('mv ../log/'+self.tarfilename+'*.log ./log/')
-                except:
-                    pass
+                        self.dolistobs(kw_mstransform['outputvis'])
+                        FileOps.rm_rf(kw_mstransform['vis'],kw_mstransform['vis']+'.listobs')
 
-                try:
-                    os.system('mv ./*.py ./log/')
-                except:
-                    pass
+                FileOps.mkdir_p('log')
+                if FileOps.mv('./casa-*.log','./log/')+FileOps.cp('./calibrated/*.listobs','./log/') != []:
+                    print('ERRPR: copy casalog failed')
+                FileOps.mv('../log/'+self.tarfilename+'*.log','./log/')
+                FileOps.mv('./*.py','./log/')
 
-                os.system('rm -rf *.last')
-                os.system('rm -rf byspw')
-                os.system('rm -rf tempfiles')
-                os.system('rm -rf '+self.asdmname+'*')
-                os.system('rm -rf '+self.projID)
+                FileOps.rm_rf('*.last','byspw','tempfiles',self.asdmname+'*',self.projID)
 
 
                 if gzip:
-                    os.system('gzip -1 -v '+glob.glob('*.tar')[0])
-                    os.system('rm -rf '+'calibrated.tar.gz')
+                    if self.tarpolicy == 'compress' and os.path.exists(self.tarfilename):
+                        # pigz compresses on all cores when available
+                        import shutil
+                        if shutil.which('pigz') != None:
+                            os.system('pigz -1 '+self.tarfilename)
+                        else:
+                            os.system('gzip -1 '+self.tarfilename)
+                    elif self.tarpolicy == 'drop':
+                        FileOps.rm_rf(self.tarfilename)
+                    FileOps.rm_rf('calibrated.tar.gz')
                     os.system('tar -zcvf calibrated.tar.gz calibrated')
-                    os.system('rm -rf ./calibrated')
+                    FileOps.rm_rf('./calibrated')
 
 
         self.writelog('step7:OK')
 
 
     # step8: spectrum plot
-    def specplot(self,dryrun=False):
+    # step8-1: spectral summary of every calibrator spectrum, cached in specdata/<asdm>.specsummary.json;
+    # entries are recomputed only when their .dat file changed
+    def specsummary(self,dryrun=False):
+        summaryfile = './specdata/'+self.asdmname+'.specsummary.json'
+        summary = {}
+        if os.path.exists(summaryfile):
+            with open(summaryfile,'r') as f:
+                summary = json.load(f)
+        if dryrun:
+            return summary
+
+        for field in self.fields:
+            if field[0] == 'J':
+                for spw in self.spws:
+                    for selfcal in ['noselfcal','selfcal']:
+                        key = field+'/spw_'+spw+'/'+selfcal
+                        specfile = './specdata/'+self.visname+'.split.'+field+'.spw_'+spw+'.'+selfcal+'.dat'
+                        if not os.path.exists(specfile):
+                            summary[key] = {'specfile':specfile,'error':'not found'}
+                            continue
+
+                        stat = os.stat(specfile)
+                        if key in summary and summary[key].get('mtime') == stat.st_mtime and summary[key].get('size') == stat.st_size:
+                            continue
+
+                        entry = {'specfile':specfile,'mtime':stat.st_mtime,'size':stat.st_size,'field':field,'spw':spw,'selfcal':selfcal,'error':None}
+                        try:
+                            data = np.loadtxt(specfile)
+                            entry.update(spectral_summary(data[:,0]/1.0e9,data[:,1]))
+                        except Exception as e:
+                            entry['error'] = repr(e)
+                        summary[key] = entry
+
+        tmpfile = summaryfile+'.tmp'
+        with open(tmpfile,'w') as f:
+            json.dump(summary,f,indent=1)
+        os.replace(tmpfile,summaryfile)
+        return summary
+
+    # step8: spectral summary + line/continuum plots (formats: default self.plotformats), rendered on
+    # nproc spawned workers; plots newer than their .dat file are kept
+    def specplot(self,dryrun=False,formats=None,nproc=None):
 
         failflag = False
 
         if not dryrun:
-            from astropy import stats
-            import matplotlib.pyplot as plt
-
-            for field in self.fields:
-                if field[0] == 'J':
-                    for spw in self.spws:
-                        for selfcal in ['noselfcal','selfcal']:
-                            try:
-                                specfile = './specdata/'+self.visname+'.split.'+field+'.spw_'+spw+'.'+selfcal+'.dat'
-                                data = np.loadtxt(specfile)
-                                freq = data[:,0]/1.0e9 #GHz
-                                spec = data[:,1] #Jy
-                                spec_ma = stats.sigma_clip(spec,sigma=3.)
-
-                                pp = np.ma.polyfit(freq,spec_ma,deg=1)
-                                #cont = np.ma.median(spec_ma)
-                                cont = pp[0]*freq+pp[1]
-                                rms = np.ma.std(spec_ma/cont)
-                                detect = np.ma.array(np.full_like(freq,np.ma.max(spec_ma/cont)+2.5*rms),mask=~spec_ma.mask)
-
-                                ymax = np.max(spec/cont) + 5*rms
-                                ymin = np.min(spec/cont) - 5*rms
-
-                                plt.close()
-                                plt.rcParams['font.family'] = 'Times New Roman'
-                                plt.rcParams['mathtext.fontset'] = 'stix'
-                                plt.rcParams["figure.dpi"] = 200
-                                plt.rcParams["font.size"] = 20
-
-                                plt.figure(figsize=[10,8])
-                                #plt.gca().xaxis.set_major_formatter(plt.FormatStrFormatter('%.3f'))
-
-                                plt.step(freq,spec/cont,where='mid',c='b',lw=1)
-                                plt.plot(freq,detect,'r-',lw=5)
-                                plt.xlabel('frequency [GHz]')
-                                plt.ylabel('line/continuum')
-                                titlename = self.asdmname + ': ' + field + ' spw' + spw
-                                plt.title(titlename)
-                                os.system('mkdir -p specplot')
-                                os.system('mkdir -p specplot/'+selfcal)
-                                plt.ylim(ymin,ymax)
-                                plt.savefig('./specplot/'+selfcal+'/'+self.asdmname + '.' + field + '.spw' + spw + '.pdf')
-                                plt.savefig('./specplot/'+selfcal+'/'+self.asdmname + '.' + field + '.spw' + spw + '.png')
-                                plt.close()
-
-                            except:
-                                failflag = True
+            summary = self.specsummary()
+            if formats == None:
+                formats = [fmt for fmt in self.plotformats if fmt != 'multipdf']
+
+            plots = []
+            for key in sorted(summary):
+                entry = summary[key]
+                if entry['error'] != None:
+                    print('specplot: '+key+' -> '+entry['error'])
+                    failflag = True
+                    continue
+
+                FileOps.mkdir_p('specplot/'+entry['selfcal'])
+                outbase = './specplot/'+entry['selfcal']+'/'+self.asdmname + '.' + entry['field'] + '.spw' + entry['spw']
+                outfiles = [outbase+'.'+fmt for fmt in formats]
+                if all(os.path.exists(f) and os.path.getmtime(f) >= entry['mtime'] for f in outfiles):
+                    continue
+                plots.append({'specfile':entry['specfile'],'summary':entry,'title':self.asdmname + ': ' + entry['field'] + ' spw' + entry['spw'],
+                              'outbase':outbase,'formats':formats})
+
+            if nproc == None:
+                nproc = self.uvfit_ncpu()*max(1,self.uvfit_nproc)
+            if nproc > 1 and len(plots) > 1:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                with ProcessPoolExecutor(max_workers=min(nproc,len(plots)),mp_context=multiprocessing.get_context('spawn')) as executor:
+                    futures = [(plot,executor.submit(render_specplot,plot)) for plot in plots]
+                    errors = [(plot,future.exception()) for (plot,future) in futures]
+            else:
+                errors = []
+                for plot in plots:
+                    try:
+                        render_specplot(plot)
+                        errors.append((plot,None))
+                    except Exception as e:
+                        errors.append((plot,e))
+
+            for (plot,error) in errors:
+                if error != None:
+                    print('specplot: '+plot['outbase']+' -> '+repr(error))
+                    failflag = True
 
         if failflag:
             self.writelog('step8:Partially failed')
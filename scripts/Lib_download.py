@@ -0,0 +1,271 @@
+# in-process parallel downloader (replaces wget)
+# HTTP range-resume into <file>.part, per-host connection limits, retries with backoff,
+# size verification against the manifest and aggregate throughput reporting
+# with mirrors, each file goes to the currently fastest archive mirror and fails over
+# (resuming the same .part file) to the next one on errors or stalls
+
+import os
+import ssl
+import time
+import threading
+import http.client
+import urllib.request
+import urllib.error
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+mirrors = ['https://almascience.eso.org','https://almascience.nao.ac.jp','https://almascience.nrao.edu']
+
+def unverified_context():
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+def split_mirror(url,mirrorlist=mirrors):
+    # 'https://almascience.eso.org/dataPortal/x.tar' -> ('https://almascience.eso.org','/dataPortal/x.tar')
+    for mirror in mirrorlist:
+        if url.startswith(mirror):
+            return mirror,url[len(mirror):]
+    parsed = urllib.parse.urlparse(url)
+    return parsed.scheme+'://'+parsed.netloc,url[len(parsed.scheme+'://'+parsed.netloc):]
+
+class StallError(OSError):
+    pass
+
+# the transfer ended before the expected size (dropped connection)
+class TruncatedError(OSError):
+    pass
+
+# latency/throughput bookkeeping of the archive mirrors
+class MirrorSelector():
+
+    def __init__(self,mirrorlist=mirrors,timeout=10.,alpha=0.3):
+        self.mirrors = list(mirrorlist)
+        self.timeout = timeout
+        self.alpha = alpha
+        self.context = unverified_context()
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.speed = {}
+        self.failures = {}
+
+    # time a small ranged request of path (e.g. a tarball) on every mirror
+    def probe(self,path='/tap/availability',nbytes=1024*1024):
+        for mirror in self.mirrors:
+            req = urllib.request.Request(mirror+path,headers={'Range':'bytes=0-'+str(nbytes-1)})
+            t0 = time.time()
+            try:
+                with urllib.request.urlopen(req,timeout=self.timeout,context=self.context) as res:
+                    t1 = time.time()
+                    n = len(res.read(nbytes))
+                t2 = time.time()
+            except (urllib.error.URLError,OSError,http.client.HTTPException) as e:
+                getLogger().info("mirror %s: probe failed (%s)", mirror, repr(e))
+                self.failure(mirror)
+                continue
+            with self.lock:
+                self.latency[mirror] = t1-t0
+            self.update(mirror,n,t2-t0)
+            getLogger().info("mirror %s: latency %.0f ms, %.1f MB/s", mirror, (t1-t0)*1000., self.speed[mirror]/1024./1024.)
+
+    def update(self,mirror,nbytes,seconds):
+        if seconds <= 0. or nbytes <= 0:
+            return
+        with self.lock:
+            speed = nbytes/seconds
+            if mirror in self.speed:
+                self.speed[mirror] = (1.-self.alpha)*self.speed[mirror] + self.alpha*speed
+            else:
+                self.speed[mirror] = speed
+            self.failures[mirror] = 0
+
+    def failure(self,mirror):
+        with self.lock:
+            self.failures[mirror] = self.failures.get(mirror,0) + 1
+
+    # fastest first; mirrors with recent failures go to the end, unmeasured ones in between
+    def ranked(self):
+        with self.lock:
+            return sorted(self.mirrors,key=lambda m: (self.failures.get(m,0),-self.speed.get(m,0.),self.latency.get(m,self.timeout)))
+
+    def fastest(self):
+        return self.ranked()[0]
+
+class Downloader():
+
+    # mirrors: MirrorSelector (or list of mirror urls) to pick/fail over hosts, None uses the urls as given
+    # minspeed: transfers slower than this [byte/s] over stallwindow [s] count as stalled
+    def __init__(self,download_d='./',nworker=5,perhost=4,retries=5,backoff=5.,timeout=60.,chunksize=8*1024*1024,verify_ssl=False,
+                 mirrors=None,minspeed=10*1024,stallwindow=120.):
+        self.download_d = download_d
+        self.nworker = nworker
+        self.perhost = perhost
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunksize = chunksize
+        self.minspeed = minspeed
+        self.stallwindow = stallwindow
+
+        if isinstance(mirrors,list):
+            mirrors = MirrorSelector(mirrors)
+        self.mirrors = mirrors
+
+        # --no-check-certificate equivalent by default
+        if verify_ssl:
+            self.context = ssl.create_default_context()
+        else:
+            self.context = unverified_context()
+
+        self.lock = threading.Lock()
+        self.hostlimits = {}
+        self.nbytes = 0
+        self.t0 = None
+
+    def hostlimit(self,url):
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            if not host in self.hostlimits:
+                self.hostlimits[host] = threading.Semaphore(self.perhost)
+            return self.hostlimits[host]
+
+    def add_bytes(self,n):
+        with self.lock:
+            self.nbytes = self.nbytes + n
+
+    def throughput(self):
+        # MB/s over the whole run
+        if self.t0 == None:
+            return 0.
+        return self.nbytes/1024./1024./max(time.time()-self.t0,1.e-3)
+
+    # one transfer attempt, resuming from <file>.part; returns the size on disk
+    def fetch(self,url,partfile):
+        offset = os.path.getsize(partfile) if os.path.exists(partfile) else 0
+        req = urllib.request.Request(url)
+        if offset > 0:
+            req.add_header('Range','bytes='+str(offset)+'-')
+
+        with self.hostlimit(url):
+            try:
+                res = urllib.request.urlopen(req,timeout=self.timeout,context=self.context)
+            except urllib.error.HTTPError as e:
+                # 416: the part file is already complete
+                if e.code == 416 and offset > 0:
+                    return offset
+                raise
+
+            with res:
+                if offset > 0 and res.status != 206:
+                    # server ignored the range request, start over
+                    offset = 0
+                t0 = time.time()
+                window = [t0,0]
+                nbytes = 0
+                try:
+                    with open(partfile,'ab' if offset > 0 else 'wb') as f:
+                        while True:
+                            buf = res.read(self.chunksize)
+                            if not buf:
+                                break
+                            f.write(buf)
+                            self.add_bytes(len(buf))
+                            nbytes = nbytes + len(buf)
+
+                            window[1] = window[1] + len(buf)
+                            if time.time()-window[0] > self.stallwindow:
+                                if window[1] < self.minspeed*(time.time()-window[0]):
+                                    raise StallError('stalled ('+str(window[1])+' bytes in '+str(int(time.time()-window[0]))+' s)')
+                                window = [time.time(),0]
+                finally:
+                    if self.mirrors != None:
+                        self.mirrors.update(split_mirror(url,self.mirrors.mirrors)[0],nbytes,time.time()-t0)
+
+        return os.path.getsize(partfile)
+
+    # download url into download_d, verify against size [byte] when given
+    def download(self,url,size=None):
+        filename = os.path.join(self.download_d,os.path.basename(urllib.parse.urlparse(url).path))
+        partfile = filename+'.part'
+
+        if os.path.exists(filename) and (size == None or os.path.getsize(filename) == size):
+            getLogger().info("%s already downloaded", os.path.basename(filename))
+            return {'url':url,'file':filename,'status':'done','size':os.path.getsize(filename)}
+
+        if size != None and os.path.exists(partfile) and os.path.getsize(partfile) > size:
+            os.remove(partfile)
+
+        error = None
+        failover = False
+        for attempt in range(self.retries+1):
+            if attempt > 0 and not failover:
+                wait = self.backoff*2**(attempt-1)
+                getLogger().info("%s retry %s/%s in %.0f s (%s)", os.path.basename(filename), attempt, self.retries, wait, error)
+                time.sleep(wait)
+
+            if self.mirrors != None:
+                mirror = self.mirrors.fastest()
+                src = mirror+split_mirror(url,self.mirrors.mirrors)[1]
+            else:
+                mirror = None
+                src = url
+
+            # every transfer error (incl. IncompleteRead, BadStatusLine, short reads) is a retry, never an exception
+            try:
+                got = self.fetch(src,partfile)
+                if size != None and got < size:
+                    raise TruncatedError('truncated ('+str(got)+' < '+str(size)+')')
+            except (urllib.error.URLError,OSError,http.client.HTTPException) as e:
+                error = repr(e)
+                if mirror != None:
+                    # next attempt goes to another mirror right away, resuming the same .part file
+                    self.mirrors.failure(mirror)
+                    failover = (self.mirrors.fastest() != mirror)
+                    getLogger().info("%s failed on %s (%s), next: %s", os.path.basename(filename), mirror, error, self.mirrors.fastest())
+                continue
+            failover = False
+
+            if size == None or got == size:
+                os.replace(partfile,filename)
+                return {'url':url,'file':filename,'status':'done','size':got}
+            else:
+                os.remove(partfile)
+                error = 'size mismatch ('+str(got)+' > '+str(size)+')'
+
+        return {'url':url,'file':filename,'status':'failed','size':None,'reason':error}
+
+    # urls: list of urls, sizes: list of expected sizes [byte] (or None)
+    def run(self,urls,sizes=None):
+        if sizes is None:
+            sizes = [None]*len(urls)
+        os.makedirs(self.download_d,exist_ok=True)
+
+        self.t0 = time.time()
+        self.nbytes = 0
+        stop = threading.Event()
+
+        def report():
+            while not stop.wait(30.):
+                getLogger().info("throughput: %.1f MB/s (%.2f GB transferred)", self.throughput(), self.nbytes/1024.**3)
+        threading.Thread(target=report,daemon=True).start()
+
+        # one failing file must not abort the batch
+        def download_f(url,size):
+            try:
+                return self.download(url,size)
+            except Exception as e:
+                return {'url':url,'file':None,'status':'failed','size':None,'reason':repr(e)}
+
+        with ThreadPoolExecutor(max_workers=max(1,min(len(urls),self.nworker)), thread_name_prefix="download") as executor:
+            results = list(executor.map(lambda args: download_f(*args),zip(urls,[None if s == None else int(s) for s in sizes])))
+        stop.set()
+
+        failed = [r for r in results if r['status'] != 'done']
+        getLogger().info("download end: %s files, %s failed, %.2f GB in %.0f s (%.1f MB/s)",
+                         len(results), len(failed), self.nbytes/1024.**3, time.time()-self.t0, self.throughput())
+        for r in failed:
+            print('ERROR: '+r['url']+' -> '+str(r['reason']))
+        return results
@@ -0,0 +1,317 @@
+# job runners for exec.py
+#   spawn: one fresh CASA process per tarball (original behavior)
+#   pool : N warm CASA processes (casa_worker.py) receiving jobs over a local socket
+
+import os
+import time
+import queue
+import shlex
+import shutil
+import threading
+import subprocess
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.connection import Listener
+from logging import StreamHandler, Formatter, INFO, getLogger
+
+import Lib_fileops as FileOps
+
+def init_logger():
+    handler = StreamHandler()
+    handler.setLevel(INFO)
+    handler.setFormatter(Formatter("[%(asctime)s] [%(threadName)s] %(message)s"))
+    logger = getLogger()
+    logger.addHandler(handler)
+    logger.setLevel(INFO)
+
+# rundb: Lib_rundb.RunDB recording job start/end (optional, in every runner below)
+def casa_spawn(tarfilename,skipflag='do',casacmd='casa',cmdfile='exec_analysis.py',rundb=None):
+    t0 = time.time()
+    if rundb != None:
+        rundb.job_started(tarfilename)
+
+    FileOps.mkdir_p('python_scripts','log')
+
+    jobscript = './python_scripts/'+cmdfile.replace('.py','.'+tarfilename+'.py')
+    f = open(jobscript,'w')
+    f.write('tarfilename = "'+tarfilename+'"'+'\n')
+    f.write('skipflag = "'+str(skipflag)+'"'+'\n')
+    f.write('execfile('+'"'+cmdfile+'"'+',globals())'+'\n')
+    f.close()
+
+    cmd = '"' + 'execfile('+"'"+jobscript+"'"+')' +'"'
+    print('running: '+tarfilename)
+
+    FileOps.touch('./log/'+tarfilename+'.term.log')
+    ret = os.system(casacmd+' --nologger --nogui --logfile ./log/'+tarfilename+'.casa.log -c '+cmd+' >> '+'./log/'+tarfilename+'.term.log')
+
+    result = {'tarfilename':tarfilename,'status':'done','reason':None,'elapsed':time.time()-t0}
+    if ret != 0:
+        result['status'] = 'failed'
+        result['reason'] = 'casa exit status '+str(ret)
+    if rundb != None:
+        rundb.job_finished(result)
+    return result
+
+# same interface as CASAWorkerPool, one casa process per job
+class CASASpawnPool():
+
+    def __init__(self,nworker,casacmd='casa',cmdfile='exec_analysis.py',rundb=None):
+        self.nworker = nworker
+        self.casacmd = casacmd
+        self.cmdfile = cmdfile
+        self.rundb = rundb
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.nworker,thread_name_prefix="casa")
+
+    def submit(self,tarfilename,skipflag='do'):
+        return self.executor.submit(casa_spawn,tarfilename,skipflag=skipflag,casacmd=self.casacmd,cmdfile=self.cmdfile,rundb=self.rundb)
+
+    def stop(self):
+        self.executor.shutdown(wait=True)
+
+# backpressure on free disk: acquire(key,nbytes) blocks until a job's projected footprint fits above
+# minfree and keeps it reserved until release(key). usage() (optional) gives the bytes the job already
+# has on disk, so only the part not written yet is counted against the free space.
+# A job that can never fit is admitted once nothing else is reserved (it runs alone).
+class DiskGate():
+
+    def __init__(self,path='.',minfree=500*1024**3,poll=30.):
+        self.path = path
+        self.minfree = minfree
+        self.poll = poll
+        self.reserved = {}
+        self.cond = threading.Condition()
+
+    def free(self):
+        return shutil.disk_usage(self.path).free
+
+    def pending(self):
+        total = 0
+        for (nbytes,usage) in self.reserved.values():
+            used = 0
+            if usage != None:
+                try:
+                    used = usage()
+                except OSError:
+                    pass
+            total = total + max(0,nbytes-used)
+        return total
+
+    def acquire(self,key,nbytes,usage=None):
+        with self.cond:
+            waiting = False
+            while self.reserved != {} and self.free() - self.pending() - nbytes < self.minfree:
+                if not waiting:
+                    getLogger().info("%s: waiting for disk space (%.1f GB free, %.1f GB pending)", key, self.free()/1024.**3, self.pending()/1024.**3)
+                    waiting = True
+                self.cond.wait(self.poll)
+            if self.free() - nbytes < self.minfree:
+                getLogger().info("%s: %.1f GB does not fit above minfree, admitted alone", key, nbytes/1024.**3)
+            self.reserved[key] = (nbytes,usage)
+
+    # the job finished (or failed): its footprint is on disk as far as it stays, or never will be
+    def release(self,key):
+        with self.cond:
+            self.reserved.pop(key,None)
+            self.cond.notify_all()
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+
+# bytes on disk of one job in the working directory: tarball (also .gz/.part) and its ASDM directory
+def job_disk_usage(tarfilename,asdmname):
+    used = 0
+    for f in [tarfilename,tarfilename+'.gz',tarfilename+'.part']:
+        if os.path.exists(f):
+            used = used + os.path.getsize(f)
+    for (root,dirs,files) in os.walk(asdmname):
+        for f in files:
+            try:
+                used = used + os.lstat(os.path.join(root,f)).st_size
+            except OSError:
+                pass
+    return used
+
+# admits jobs while their projected peak disk footprint (tarball size x factor: tar, asdm,
+# .ms/.ms.org/.split until init_spacesave) fits the budget; largest first, first-fit
+class DiskBudgetScheduler():
+
+    def __init__(self,runner,nworker,budget,factor=4.):
+        self.runner = runner
+        self.nworker = nworker
+        self.budget = budget
+        self.factor = factor
+
+    def footprint(self,size):
+        return size*self.factor
+
+    # jobs: [(tarfilename,size [byte]), ...]
+    def run(self,jobs,skipflag='do'):
+        pending = sorted(jobs,key=lambda job: -job[1])
+        running = {}
+        used = 0.
+        results = []
+
+        while pending != [] or running != {}:
+            for job in list(pending):
+                if len(running) >= self.nworker:
+                    break
+                fp = self.footprint(job[1])
+                # a job larger than the whole budget runs alone
+                if used+fp <= self.budget or running == {}:
+                    pending.remove(job)
+                    used = used + fp
+                    running[self.runner.submit(job[0],skipflag=skipflag)] = fp
+                    getLogger().info("%s start (%.1f/%.1f GB of budget)", job[0], used/1024.**3, self.budget/1024.**3)
+
+            done,_ = wait(list(running),return_when=FIRST_COMPLETED)
+            for future in done:
+                used = used - running.pop(future)
+                result = future.result()
+                results.append(result)
+                getLogger().info("%s end (%s)", result['tarfilename'], result['status'])
+
+        return results
+
+# tarball sizes [byte] from the URL manifest, falling back to the files on disk
+def tarball_sizes(tarfilenames,manifest=None):
+    known = {}
+    if manifest is not None:
+        known = dict(zip([os.path.basename(url) for url in manifest['url']],manifest['size']))
+
+    sizes = []
+    for tarfilename in tarfilenames:
+        size = known.get(tarfilename,0)
+        if size == 0:
+            for f in [tarfilename,tarfilename+'.gz']:
+                if os.path.exists(f):
+                    size = os.path.getsize(f)
+                    break
+        sizes.append(int(size))
+    return sizes
+
+class CASAWorkerPool():
+
+    def __init__(self,nworker,casacmd='casa',cmdfile='exec_analysis.py',workerscript='casa_worker.py',rundb=None):
+        self.nworker = nworker
+        self.casacmd = casacmd
+        self.cmdfile = cmdfile
+        self.workerscript = workerscript
+        self.rundb = rundb
+
+        self.jobs = queue.Queue()
+        self.procs = []
+        self.stopped = False
+        self.fallback = False
+        self.fallback_executor = None
+
+    def start(self):
+        FileOps.mkdir_p('log')
+
+        authkey = os.urandom(16)
+        self.listener = Listener(('localhost',0),authkey=authkey)
+
+        env = os.environ.copy()
+        env['ALMAQSO_WORKER_ADDRESS'] = 'localhost:'+str(self.listener.address[1])
+        env['ALMAQSO_WORKER_AUTHKEY'] = authkey.hex()
+
+        for i in range(self.nworker):
+            logbase = './log/worker.'+str(i)
+            cmd = shlex.split(self.casacmd)+['--nologger','--nogui','--logfile',logbase+'.casa.log','-c',self.workerscript]
+            self.procs.append(subprocess.Popen(cmd,env=env,stdout=open(logbase+'.term.log','a'),stderr=subprocess.STDOUT))
+
+        threading.Thread(target=self._accept,daemon=True).start()
+        threading.Thread(target=self._watch,daemon=True).start()
+        getLogger().info("%s CASA workers started", self.nworker)
+
+    def submit(self,tarfilename,skipflag='do'):
+        future = Future()
+        job = {'tarfilename':tarfilename,'skipflag':str(skipflag),'cmdfile':self.cmdfile}
+
+        if self.fallback:
+            self._fallback_submit(job,future)
+        else:
+            self.jobs.put((job,future))
+        return future
+
+    def stop(self):
+        self.stopped = True
+        for i in range(self.nworker):
+            self.jobs.put(None)
+
+        for p in self.procs:
+            try:
+                p.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                p.terminate()
+
+        self.listener.close()
+        if self.fallback_executor != None:
+            self.fallback_executor.shutdown(wait=True)
+
+    def _accept(self):
+        for i in range(self.nworker):
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if self.stopped:
+                    return
+                continue
+            threading.Thread(target=self._serve,args=(conn,),daemon=True).start()
+
+    def _serve(self,conn):
+        while True:
+            item = self.jobs.get()
+            if item == None:
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+                break
+
+            job,future = item
+            getLogger().info("%s -> worker", job['tarfilename'])
+            if self.rundb != None:
+                self.rundb.job_started(job['tarfilename'])
+            try:
+                conn.send(job)
+                result = conn.recv()
+            except (EOFError,OSError):
+                result = {'tarfilename':job['tarfilename'],'status':'failed','reason':'CASA worker died','elapsed':None}
+                if self.rundb != None:
+                    self.rundb.job_finished(result)
+                future.set_result(result)
+                break
+            if self.rundb != None:
+                self.rundb.job_finished(result)
+            future.set_result(result)
+
+        conn.close()
+
+    # once every worker process has exited, run whatever is queued as one CASA process per job
+    def _watch(self):
+        while not self.stopped:
+            if not self.fallback and all(p.poll() != None for p in self.procs):
+                getLogger().info("all CASA workers exited, fallback to one process per job")
+                self.fallback = True
+
+            if self.fallback:
+                while True:
+                    try:
+                        item = self.jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item != None:
+                        self._fallback_submit(*item)
+            time.sleep(1)
+
+    def _fallback_submit(self,job,future):
+        if self.fallback_executor == None:
+            self.fallback_executor = ThreadPoolExecutor(max_workers=self.nworker,thread_name_prefix="fallback")
+
+        def run():
+            future.set_result(casa_spawn(job['tarfilename'],skipflag=job['skipflag'],casacmd=self.casacmd,cmdfile=job['cmdfile'],rundb=self.rundb))
+        self.fallback_executor.submit(run)
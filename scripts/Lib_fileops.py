@@ -0,0 +1,114 @@
+# in-process file operations (instead of os.system('mkdir -p/rm -rf/mv/cp/touch/ln -sf/echo >>'))
+# no shell: names are not word-split; arguments are glob patterns like in the shell, except that an
+# existing path is always taken literally. Every function returns the list of errors (also printed),
+# an empty list on success.
+
+import os
+import glob
+import shutil
+
+def _expand(pattern):
+    if os.path.lexists(pattern):
+        return [pattern]
+    return sorted(glob.glob(pattern))
+
+def _report(errors):
+    for error in errors:
+        print('ERROR: fileops: '+error)
+    return errors
+
+def mkdir_p(*paths):
+    errors = []
+    for path in paths:
+        try:
+            os.makedirs(path,exist_ok=True)
+        except OSError as e:
+            errors.append('mkdir '+path+': '+str(e))
+    return _report(errors)
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+# rm -rf for any number of paths/patterns in one call; missing paths are not an error
+def rm_rf(*patterns):
+    errors = []
+    for pattern in patterns:
+        for path in _expand(pattern):
+            try:
+                _remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                errors.append('rm '+path+': '+str(e))
+    return _report(errors)
+
+# mv src... dst: into dst if it is a directory (or several sources match), otherwise renamed to dst
+def mv(src,dst):
+    errors = []
+    srcs = _expand(src)
+    if srcs == []:
+        return _report(['mv '+src+': no such file or directory'])
+    for path in srcs:
+        target = dst
+        if os.path.isdir(dst):
+            target = os.path.join(dst,os.path.basename(path.rstrip('/')))
+        try:
+            if os.path.lexists(target) and os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            shutil.move(path,target)
+        except OSError as e:
+            errors.append('mv '+path+' '+dst+': '+str(e))
+    return _report(errors)
+
+# cp -r src... dst
+def cp(src,dst):
+    errors = []
+    srcs = _expand(src)
+    if srcs == []:
+        return _report(['cp '+src+': no such file or directory'])
+    for path in srcs:
+        target = dst
+        if os.path.isdir(dst):
+            target = os.path.join(dst,os.path.basename(path.rstrip('/')))
+        try:
+            if os.path.isdir(path):
+                shutil.copytree(path,target,symlinks=True,dirs_exist_ok=True)
+            else:
+                shutil.copy2(path,target)
+        except (OSError,shutil.Error) as e:
+            errors.append('cp '+path+' '+dst+': '+str(e))
+    return _report(errors)
+
+def touch(path):
+    try:
+        with open(path,'a'):
+            os.utime(path,None)
+    except OSError as e:
+        return _report(['touch '+path+': '+str(e)])
+    return []
+
+# ln -sf src dst (dst: link name, or a directory to put the link in)
+def symlink(src,dst):
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        dst = os.path.join(dst,os.path.basename(src.rstrip('/')))
+    try:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.symlink(src,dst)
+    except OSError as e:
+        return _report(['ln '+src+' '+dst+': '+str(e)])
+    return []
+
+# echo line >> path
+def append_line(path,line):
+    try:
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,'a') as f:
+            f.write(line+'\n')
+    except OSError as e:
+        return _report(['append '+path+': '+str(e)])
+    return []
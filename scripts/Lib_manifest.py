@@ -0,0 +1,73 @@
+# typed URL manifest of ASDM tarballs
+# structured numpy array (saved with np.save, no pickle) with the columns
+#   url, size [byte], mous, project, array (12m/7m/TP), band
+
+import os
+import numpy as np
+
+fields = [('size','int64'),('mous','<U64'),('project','<U32'),('array','<U4'),('band','<U4')]
+
+def manifest_dtype(urlwidth=120):
+    return np.dtype([('url','<U'+str(max(1,urlwidth)))]+fields)
+
+def make_manifest(rows):
+    # rows: [(url,size,mous,project,array,band), ...]
+    urlwidth = max([len(row[0]) for row in rows]) if rows != [] else 1
+    return np.array([tuple(row) for row in rows],dtype=manifest_dtype(urlwidth))
+
+def tarfilename_from_url(url):
+    return os.path.basename(url)
+
+def asdmname_from_url(url):
+    tarfilename = tarfilename_from_url(url)
+    return 'uid___' + (tarfilename.split('_uid___')[1]).replace('.asdm.sdm.tar','')
+
+def array_type(antenna_arrays):
+    # obscore antenna_arrays, e.g. 'A001:DA41 A002:DV03 ...'
+    if ('DV' in antenna_arrays) or ('DA' in antenna_arrays):
+        return '12m'
+    elif 'CM' in antenna_arrays:
+        return '7m'
+    elif 'PM' in antenna_arrays:
+        return 'TP'
+    return ''
+
+# legacy manifests are [[url,size], ...] string arrays from older QSOquery.get_data_urls
+def from_legacy(urllist):
+    rows = []
+    for (url,size) in urllist[:,:2]:
+        rows.append((url,int(float(size)),'',tarfilename_from_url(url).split('_uid___')[0],'',''))
+    return make_manifest(rows)
+
+def load_manifest(paths):
+    if isinstance(paths,str):
+        paths = [paths]
+
+    manifests = []
+    for path in paths:
+        urllist = np.load(path)
+        if urllist.dtype.names == None:
+            if urllist.size == 0:
+                continue
+            urllist = from_legacy(urllist.reshape(-1,urllist.shape[-1]))
+        manifests.append(urllist)
+    return concat_manifests(manifests)
+
+def concat_manifests(manifests):
+    if manifests == []:
+        return make_manifest([])
+    urlwidth = max([m.dtype['url'].itemsize//4 for m in manifests])
+    return np.concatenate([m.astype(manifest_dtype(urlwidth)) for m in manifests])
+
+def save_manifest(path,manifest):
+    np.save(path,manifest)
+
+# validation report of check_and_run.py (exec_tarlist.v<date>.json): tarball names with the given
+# status and a manifest of their sizes
+def load_report(path,status=['complete']):
+    import json
+    with open(path,'r') as f:
+        report = json.load(f)
+    files = [r for r in report['files'] if r['status'] in status]
+    tarfilenames = np.array([r['tarfilename'] for r in files])
+    return tarfilenames,make_manifest([(r['tarfilename'],r['size'],'','','','') for r in files])
@@ -3,10 +3,17 @@ import numpy as np
 import pyvo
 import pandas as pd
 import os
+import time
+import pickle
+import sqlite3
+import threading
 
 from concurrent.futures import ThreadPoolExecutor
 from logging import StreamHandler, Formatter, INFO, getLogger
 
+import Lib_manifest as Manifest
+import Lib_download as Download
+
 def init_logger():
     handler = StreamHandler()
     handler.setLevel(INFO)
@@ -15,8 +22,118 @@ def init_logger():
     logger.addHandler(handler)
     logger.setLevel(INFO)
 
+def adql_str(s):
+    return "'"+str(s).replace("'","''")+"'"
+
+# on-disk cache of TAP rows and datalink tables (sqlite, TTL + size-bounded LRU eviction)
+# offline=True answers purely from the cache, including expired entries
+class QueryCache:
+    def __init__(self,path='./cache/almaquery.sqlite',ttl=30*86400.,maxsize=2*1024**3,offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.offline = offline
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+        self.db = sqlite3.connect(path,check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL, size INTEGER)')
+        self.db.commit()
+
+    def get(self,key):
+        with self.lock:
+            row = self.db.execute('SELECT value,created FROM cache WHERE key=?',(key,)).fetchone()
+            if row == None:
+                return None
+            if (not self.offline) and (time.time()-row[1] > self.ttl):
+                return None
+            self.db.execute('UPDATE cache SET accessed=? WHERE key=?',(time.time(),key))
+            self.db.commit()
+        return pickle.loads(row[0])
+
+    def put(self,key,value):
+        blob = pickle.dumps(value,protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO cache VALUES (?,?,?,?,?)',(key,blob,now,now,len(blob)))
+            self.db.commit()
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            if not self.offline:
+                self.db.execute('DELETE FROM cache WHERE created < ?',(time.time()-self.ttl,))
+            total = self.db.execute('SELECT COALESCE(SUM(size),0) FROM cache').fetchone()[0]
+            if total > self.maxsize:
+                for (key,size) in self.db.execute('SELECT key,size FROM cache ORDER BY accessed').fetchall():
+                    self.db.execute('DELETE FROM cache WHERE key=?',(key,))
+                    total = total - size
+                    if total <= self.maxsize:
+                        break
+            self.db.commit()
+
+    def cached(self,key,func):
+        value = self.get(key)
+        if value is None:
+            if self.offline:
+                raise KeyError('offline mode: '+key+' is not in the cache')
+            value = func()
+            self.put(key,value)
+        return value
+
+# query many sources with 'target_name IN (...)' chunks, returns {sname: obscore rows}
+# sources already in the cache are not queried again (offline: sources not in the cache are skipped)
+# kw: obscore selection of QSOquery (only12m, onlyFDM, mindate, ...)
+def query_batch(snames,band='4',almaurl='https://almascience.nao.ac.jp',chunksize=50,almaquery=True,cache=None,**kw):
+    snames = list(snames)
+    obj = QSOquery(snames,band=band,almaurl=almaurl,cache=cache,**kw)
+
+    raw = {}
+    if cache != None:
+        for sname in snames:
+            tmp = cache.get(obj.cache_key(sname))
+            if tmp is not None:
+                raw[sname] = tmp
+        if cache.offline:
+            # like serial queries: missing sources are reported and left out of the results
+            for sname in snames:
+                if not sname in raw:
+                    print('ERROR: '+sname+' -> not in the cache (offline mode), skipped')
+            snames = [sname for sname in snames if sname in raw]
+
+    todo = [sname for sname in snames if not sname in raw]
+    for i in range(0,len(todo),chunksize):
+        chunk = todo[i:i+chunksize]
+        tmp = obj.fetch_obscore(obj.build_query(chunk),almaquery=almaquery)
+        groups = dict(tuple(tmp.groupby('target_name')))
+        for sname in chunk:
+            if sname in groups:
+                raw[sname] = groups[sname].reset_index(drop=True)
+            else:
+                raw[sname] = tmp.iloc[0:0]
+            if cache != None:
+                cache.put(obj.cache_key(sname),raw[sname])
+        print('[batch query] '+str(min(i+chunksize,len(todo)))+'/'+str(len(todo)))
+
+    results = {}
+    for sname in snames:
+        results[sname] = obj.filter_obscore(raw[sname])
+    return results
+
+# archive mirror with the lowest TAP latency
+def select_almaurl(mirrors=Download.mirrors):
+    selector = Download.MirrorSelector(mirrors)
+    selector.probe('/tap/availability',nbytes=4096)
+    print('archive mirror: '+selector.fastest())
+    return selector.fastest()
+
 class QSOquery:
-    def __init__(self,sname,band='4',almaurl='https://almascience.nao.ac.jp',download_d='./',replaceNAOJ=False,only12m=False,onlyFDM=False):
+    # obscore selection (pushed down into the ADQL and applied again on the returned rows):
+    #   only12m: 12m array (DV/DA antennas), onlyFDM: velocity_resolution < maxvelres [m/s]
+    #   mindate/maxdate: observation start date range ('2019-10-01'), data_rights: None for no restriction
+    #   where: extra ADQL conditions, e.g. ["s_resolution < 1.0"]
+    def __init__(self,sname,band='4',almaurl='https://almascience.nao.ac.jp',download_d='./',replaceNAOJ=False,only12m=False,onlyFDM=False,cache=None,
+                 maxvelres=50000.,mindate=None,maxdate=None,data_rights='Public',where=[]):
         self.sname = sname
         self.band = band
         self.almaurl = almaurl
@@ -26,87 +143,133 @@ class QSOquery:
         self.replaceNAOJ=replaceNAOJ
         self.only12m = only12m
         self.onlyFDM = onlyFDM
+        self.cache = cache
+        self.maxvelres = maxvelres
+        self.mindate = mindate
+        self.maxdate = maxdate
+        self.data_rights = data_rights
+        self.where = where
 
-    def queryALMA(self,almaquery=True):
-        service = pyvo.dal.TAPService(self.almaurl+"/tap")
+    def cached(self,key,func):
+        if self.cache == None:
+            return func()
+        return self.cache.cached(key,func)
+
+    def mjd(self,date):
+        from astropy.time import Time
+        return Time(date).mjd
+
+    # ADQL conditions of the obscore selection
+    def predicates(self):
+        pred = ["band_list = "+adql_str(self.band)]
+        if self.data_rights != None:
+            pred.append("data_rights = "+adql_str(self.data_rights))
+        if self.only12m:
+            pred.append("(antenna_arrays LIKE '%DV%' OR antenna_arrays LIKE '%DA%')")
+        if self.onlyFDM:
+            pred.append("velocity_resolution < "+str(self.maxvelres))
+        if self.mindate != None:
+            pred.append("t_min >= "+str(self.mjd(self.mindate)))
+        if self.maxdate != None:
+            pred.append("t_min <= "+str(self.mjd(self.maxdate)))
+        return pred + list(self.where)
+
+    # sname can be a single source or a list of sources (batched query)
+    def build_query(self,sname=None):
+        if sname is None:
+            sname = self.sname
+
+        if isinstance(sname,str):
+            target = "target_name = "+adql_str(sname)
+        else:
+            target = "target_name IN ("+",".join([adql_str(s) for s in sname])+")"
 
         query = f"""
                 SELECT *
                 FROM ivoa.obscore
-                WHERE target_name = '{self.sname}'  AND band_list = '{self.band}' AND data_rights = 'Public' """
+                WHERE {target} AND """ + " AND ".join(self.predicates())
+        return query
 
-        if almaquery:
-            tmp = self.myAlma.query_tap(query).to_table().to_pandas()
-            if self.only12m:
-                flag = [('DV' in tmp['antenna_arrays'][i]) or ('DA' in tmp['antenna_arrays'][i]) for i in range(len(tmp))]
-
-                if self.onlyFDM:
-                    return tmp[flag][tmp[flag]['velocity_resolution'] < 50000]
-                else:
-                    return tmp[flag]
-            else:
-                if self.onlyFDM:
-                    return tmp[tmp['velocity_resolution'] < 50000]
-                else:
-                    return tmp
+    def cache_key(self,sname=None):
+        return 'tap:'+self.almaurl+':'+self.build_query(sname)
 
+    def fetch_obscore(self,query,almaquery=True):
+        if almaquery:
+            return self.myAlma.query_tap(query).to_table().to_pandas()
         else:
-            tmp = service.search(query).to_table().to_pandas()
-            if self.only12m:
-                flag = [('DV' in tmp['antenna_arrays'][i]) or ('DA' in tmp['antenna_arrays'][i]) for i in range(len(tmp))]
-
-                if self.onlyFDM:
-                    return tmp[flag][tmp[flag]['velocity_resolution'] < 50000]
-                else:
-                    return tmp[flag]
-            else:
-                if self.onlyFDM:
-                    return tmp[tmp['velocity_resolution'] < 50000]
-                else:
-                    return tmp
+            service = pyvo.dal.TAPService(self.almaurl+"/tap")
+            return service.search(query).to_table().to_pandas()
+
+    # the same selection as predicates(), as one vectorized mask over the returned rows
+    def filter_obscore(self,tmp):
+        mask = np.ones(len(tmp),dtype='bool')
+        if self.data_rights != None:
+            mask &= (tmp['data_rights'] == self.data_rights).to_numpy()
+        if self.only12m:
+            mask &= tmp['antenna_arrays'].astype(str).str.contains('DV|DA').to_numpy()
+        if self.onlyFDM:
+            mask &= (tmp['velocity_resolution'] < self.maxvelres).to_numpy()
+        if self.mindate != None:
+            mask &= (tmp['t_min'] >= self.mjd(self.mindate)).to_numpy()
+        if self.maxdate != None:
+            mask &= (tmp['t_min'] <= self.mjd(self.maxdate)).to_numpy()
+        return tmp[mask]
+
+    def queryALMA(self,almaquery=True):
+        tmp = self.cached(self.cache_key(),lambda: self.fetch_obscore(self.build_query(),almaquery=almaquery))
+        return self.filter_obscore(tmp)
 
-    def get_data_urls(self,almaquery=True):
-        rlist = self.queryALMA(almaquery=almaquery)
+    # datalink table of one MOUS (only the columns used here are cached)
+    def data_info(self,mous):
+        def fetch():
+            uid_url_table = self.myAlma.get_data_info(mous)
+            return {'access_url':list(uid_url_table['access_url']),'content_length':list(uid_url_table['content_length'])}
+        return self.cached('datalink:'+self.almaurl+':'+mous,fetch)
+
+    # rlist: obscore rows from query_batch (skip the TAP query), nworker: concurrent get_data_info lookups
+    def get_data_urls(self,almaquery=True,rlist=None,nworker=1):
+        if rlist is None:
+            rlist = self.queryALMA(almaquery=almaquery)
         mous_list = np.unique(rlist['member_ous_uid'])
 
+        with ThreadPoolExecutor(max_workers=max(1,min(nworker,len(mous_list))), thread_name_prefix="datainfo") as executor:
+            uid_url_tables = list(executor.map(self.data_info,mous_list))
+
+        # per-MOUS project and array type from the obscore rows
+        mous_info = rlist.drop_duplicates('member_ous_uid').set_index('member_ous_uid')
+
         total_size = 0.
-        url_list = np.zeros([1,2]).astype(dtype='<U120')
-        for (id,mous) in zip(range(len(mous_list)),mous_list):
-            uid_url_table = self.myAlma.get_data_info(mous)
+        rows = []
+        for (id,mous,uid_url_table) in zip(range(len(mous_list)),mous_list,uid_url_tables):
 
-            url_size = [[url,size] for (url,size) in zip(uid_url_table['access_url'],uid_url_table['content_length']) if '.asdm.sdm.tar' in url]
+            url_size = [(str(url),int(size)) for (url,size) in zip(uid_url_table['access_url'],uid_url_table['content_length']) if '.asdm.sdm.tar' in url]
             if not url_size == []:
-                asdm_size = (np.array(url_size)[:,1].astype('float')).sum()/1024./1024./1024.
+                asdm_size = sum([size for (url,size) in url_size])/1024./1024./1024.
 
-                url_list = np.vstack([url_list,np.array(url_size)])
+                project = str(mous_info['proposal_id'][mous]) if 'proposal_id' in mous_info else ''
+                array = Manifest.array_type(str(mous_info['antenna_arrays'][mous])) if 'antenna_arrays' in mous_info else ''
+                rows.extend([(url,size,mous,project,array,self.band) for (url,size) in url_size])
                 print('['+str(id+1)+'/'+str(len(mous_list))+'] '+str(asdm_size))
                 total_size = total_size + asdm_size
 
             else:
                 print('['+str(id+1)+'/'+str(len(mous_list))+'] -> skipped (may be SV)')
 
-        url_list = url_list[1:]
-
         self.rlist = rlist
         self.total_size = total_size
-        self.url_list = url_list
-
-    def wget_f(self,num):
-        getLogger().info("%s start", num)
-        if self.replaceNAOJ:
-            download_url = (self.url_list[num][0]).replace(self.almaurl,"https://almascience.nao.ac.jp")
-        else:
-            download_url = self.url_list[num][0]
-        print('wget -q --no-check-certificate -P '+self.download_d+' '+download_url)
-        os.system('wget -q --no-check-certificate -P '+self.download_d+' '+download_url)
-        getLogger().info("%s end", num)
+        self.url_list = Manifest.make_manifest(rows)
 
-    def download(self):
-        nFiles = self.url_list.shape[0]
+    # mirrors: list of archive mirrors to probe and fail over between (replaces replaceNAOJ)
+    def download(self,nworker=5,mirrors=None):
         init_logger()
         getLogger().info("main start")
-        with ThreadPoolExecutor(max_workers=min(nFiles,5), thread_name_prefix="thread") as executor:
-            for i in range(nFiles):
-                executor.submit(self.wget_f, i)
-            getLogger().info("submit end")
+        urls = list(self.url_list['url'])
+        if mirrors != None:
+            mirrors = Download.MirrorSelector(mirrors)
+            if urls != []:
+                mirrors.probe(Download.split_mirror(urls[0],mirrors.mirrors)[1])
+        elif self.replaceNAOJ:
+            urls = [url.replace(self.almaurl,"https://almascience.nao.ac.jp") for url in urls]
+        downloader = Download.Downloader(download_d=self.download_d,nworker=nworker,mirrors=mirrors)
+        self.download_results = downloader.run(urls,sizes=list(self.url_list['size']))
         getLogger().info("main end")
@@ -0,0 +1,88 @@
+# run-state database of exec.py / pipeline.py (sqlite, default ./log/run.sqlite)
+# one row per tarball: status (queued, running, done, failed), current analysis step, times, exit status/reason
+# written by the executor (job start/end) and by QSOanalysis.runstep (current step, via $ALMAQSO_RUNDB);
+# read by run_status.py
+
+import os
+import time
+import sqlite3
+import threading
+
+class RunDB:
+    def __init__(self,path='./log/run.sqlite',timeout=60.):
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.path),exist_ok=True)
+        self.db = sqlite3.connect(self.path,timeout=timeout,check_same_thread=False)
+        # readers (run_status.py) do not block the writers
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs (tarfilename TEXT PRIMARY KEY, size INTEGER, status TEXT, step TEXT, '
+                        'queued REAL, started REAL, stepstarted REAL, finished REAL, elapsed REAL, exitstatus TEXT, reason TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+
+    def execute(self,sql,args=()):
+        with self.lock:
+            self.db.execute(sql,args)
+            self.db.commit()
+
+    def query(self,sql,args=()):
+        with self.lock:
+            return self.db.execute(sql,args).fetchall()
+
+    def set_run(self,key,value):
+        self.execute('INSERT OR REPLACE INTO run VALUES (?,?)',(key,str(value)))
+
+    def get_run(self):
+        return dict(self.query('SELECT key,value FROM run'))
+
+    # new run: jobs [(tarfilename,size [byte]), ...]; jobs of an earlier run in the same database are re-queued
+    def start_run(self,jobs,**info):
+        now = time.time()
+        self.set_run('started',now)
+        for (k,v) in info.items():
+            self.set_run(k,v)
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                                [(tarfilename,int(size),'queued',None,now,None,None,None,None,None,None) for (tarfilename,size) in jobs])
+            self.db.commit()
+
+    def add_job(self,tarfilename,size=0):
+        self.execute('INSERT OR REPLACE INTO jobs VALUES (?,?,?,?,?,?,?,?,?,?,?)',(tarfilename,int(size),'queued',None,time.time(),None,None,None,None,None,None))
+
+    def job_started(self,tarfilename):
+        self.execute('UPDATE jobs SET status=?, started=?, step=NULL, stepstarted=NULL WHERE tarfilename=?',('running',time.time(),tarfilename))
+
+    # result: {'tarfilename','status','reason','elapsed'} from Lib_exec runners
+    def job_finished(self,result):
+        exitstatus = None
+        if result['reason'] != None:
+            exitstatus = str(result['reason']).strip().split('\n')[-1]
+        self.execute('UPDATE jobs SET status=?, finished=?, elapsed=?, exitstatus=?, reason=? WHERE tarfilename=?',
+                     (result['status'],time.time(),result['elapsed'],exitstatus,result['reason'],result['tarfilename']))
+
+    def jobs(self,status=None):
+        cols = ['tarfilename','size','status','step','queued','started','stepstarted','finished','elapsed','exitstatus','reason']
+        if status == None:
+            rows = self.query('SELECT * FROM jobs')
+        else:
+            rows = self.query('SELECT * FROM jobs WHERE status=?',(status,))
+        return [dict(zip(cols,row)) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# current step of this CASA process's job, for QSOanalysis.runstep: no-op unless $ALMAQSO_RUNDB is set
+def report_step(tarfilename,step):
+    path = os.environ.get('ALMAQSO_RUNDB')
+    if path == None or path == '':
+        return
+    try:
+        db = sqlite3.connect(path,timeout=60.)
+        db.execute('UPDATE jobs SET step=?, stepstarted=? WHERE tarfilename=?',(str(step),time.time(),tarfilename))
+        db.commit()
+        db.close()
+    except sqlite3.Error as e:
+        print('rundb: '+repr(e))
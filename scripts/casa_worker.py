@@ -0,0 +1,70 @@
+# persistent CASA worker for exec.py pool mode
+# started by Lib_exec.CASAWorkerPool as: casa --nologger --nogui -c casa_worker.py
+# each job runs exec_analysis.py with stdout/stderr and the casa log redirected to
+# ./log/<tar>.term.log and ./log/<tar>.casa.log, like the one-process-per-job mode
+
+import os
+import sys
+import time
+import traceback
+from multiprocessing.connection import Client
+from casatasks import casalog
+
+sys.path.append('.')
+import Lib_fileops as FileOps
+
+host,port = os.environ['ALMAQSO_WORKER_ADDRESS'].split(':')
+conn = Client((host,int(port)),authkey=bytes.fromhex(os.environ['ALMAQSO_WORKER_AUTHKEY']))
+
+topdir = os.getcwd()
+workerlog = casalog.logfile()
+
+while True:
+    try:
+        job = conn.recv()
+    except EOFError:
+        break
+    if job == None:
+        break
+
+    t0 = time.time()
+    tarfilename = job['tarfilename']
+    status = 'done'
+    reason = None
+
+    os.chdir(topdir)
+    FileOps.mkdir_p('log')
+    termlog = open('./log/'+tarfilename+'.term.log','a')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1),os.dup(2)]
+    os.dup2(termlog.fileno(),1)
+    os.dup2(termlog.fileno(),2)
+    casalog.setlogfile(os.path.abspath('./log/'+tarfilename+'.casa.log'))
+
+    try:
+        print('running: '+tarfilename)
+        g = {'__name__':'__main__','tarfilename':tarfilename,'skipflag':job['skipflag']}
+        exec(compile(open(job['cmdfile']).read(),job['cmdfile'],'exec'),g)
+    except SystemExit as e:
+        if not e.code in [None,0]:
+            status = 'failed'
+            reason = 'exit '+str(e.code)
+    except Exception:
+        status = 'failed'
+        reason = traceback.format_exc()
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0],1)
+        os.dup2(saved[1],2)
+        os.close(saved[0])
+        os.close(saved[1])
+        termlog.close()
+        casalog.setlogfile(workerlog)
+        os.chdir(topdir)
+
+    conn.send({'tarfilename':tarfilename,'status':status,'reason':reason,'elapsed':time.time()-t0})
+
+conn.close()
@@ -1,46 +1,158 @@
+# validates the downloaded tarballs (*.tar) against the URL manifest and lists the ones to analyze
+# usage: python check_and_run.py <urllist.npy> <asdm12m.npy> [save|rm] [size|header|md5] [nworker]
+#   size  : file size == manifest size
+#   header: + walk the tar headers (every member must lie within the file)
+#   md5   : + streamed md5 of the whole file, compared with the md5 of the same file (name and size)
+#           in the previous reports exec_tarlist.v*.json; a mismatch is corrupt, without a reference
+#           the md5 is only recorded (md5_reference: null) for the next run
+# each file is classified as complete, truncated, corrupt, 7m or unknown in exec_tarlist.v<date>.json;
+# the complete ones also go to exec_tarlist.v<date>.npy. Both can be given to exec.py.
+# rm: truncated/corrupt files are removed
+
 import os
 import glob
+import json
+import hashlib
+import tarfile
 import numpy as np
 import sys
 import datetime
 
+sys.path.append('.')
+import Lib_manifest as Manifest
+import Lib_fileops as FileOps
+
+from concurrent.futures import ThreadPoolExecutor
+
 args = sys.argv
 
-tarlist = glob.glob('*.tar')
-urllist = np.load(args[1])
-asdm12m = np.load(args[2])
+tarlist = sorted(glob.glob('*.tar'))
+urllist = Manifest.load_manifest(args[1])
+asdm12m = Manifest.load_manifest(args[2])
 
 try:
     rmflag = str(args[3])
 except:
     rmflag = 'save'
+try:
+    check = str(args[4])
+except:
+    check = 'size'
+try:
+    nworker = int(args[5])
+except:
+    nworker = 8
+
+# hash indexes by tarball name (independent of the mirror in the url)
+expected = dict(zip([Manifest.tarfilename_from_url(url) for url in urllist['url']],[int(size) for size in urllist['size']]))
+is12m = set(Manifest.tarfilename_from_url(url) for url in asdm12m['url'])
+
+# {(tarfilename,size): (md5,report)} of the complete files in the previous reports, the newest one wins
+def md5_references(pattern='exec_tarlist.v*.json'):
+    references = {}
+    for path in sorted(glob.glob(pattern)):
+        try:
+            with open(path,'r') as fp:
+                files = json.load(fp)['files']
+        except (OSError,ValueError,KeyError):
+            continue
+        for r in files:
+            if r.get('md5') != None and r.get('status') == 'complete':
+                references[(r['tarfilename'],r['size'])] = (r['md5'],path)
+    return references
+
+references = md5_references() if check == 'md5' else {}
+
+def tar_header_check(f):
+    size = os.path.getsize(f)
+    nmember = 0
+    with tarfile.open(f,'r:') as tar:
+        for member in tar:
+            if member.offset_data+member.size > size:
+                return 'member '+member.name+' beyond end of file'
+            nmember = nmember + 1
+    if nmember == 0:
+        return 'no members'
+    return None
+
+def md5sum(f,chunksize=16*1024*1024):
+    md5 = hashlib.md5()
+    with open(f,'rb') as fp:
+        while True:
+            buf = fp.read(chunksize)
+            if not buf:
+                break
+            md5.update(buf)
+    return md5.hexdigest()
+
+def validate(f):
+    size = os.path.getsize(f)
+    result = {'tarfilename':f,'status':'complete','size':size,'expected':expected.get(f),'reason':None,'md5':None,'md5_reference':None}
 
-exec_tarlist = []
+    if result['expected'] == None and not f in is12m:
+        result['status'] = 'unknown'
+        result['reason'] = 'not in the manifests'
+        return result
+    if result['expected'] != None and size < result['expected']:
+        result['status'] = 'truncated'
+        result['reason'] = str(result['expected']-size)+' bytes missing'
+        return result
+    if result['expected'] != None and size > result['expected']:
+        result['status'] = 'corrupt'
+        result['reason'] = str(size-result['expected'])+' bytes more than in the manifest'
+        return result
+    if not f in is12m:
+        result['status'] = '7m'
+        return result
 
-ireg_f = []
-ireg_size = []
+    try:
+        if check in ['header','md5']:
+            result['reason'] = tar_header_check(f)
+        if check == 'md5' and result['reason'] == None:
+            result['md5'] = md5sum(f)
+            if (f,size) in references:
+                md5,report = references[(f,size)]
+                result['md5_reference'] = report
+                if result['md5'] != md5:
+                    result['reason'] = 'md5 '+result['md5']+' != '+md5+' in '+report
+    except (OSError,tarfile.TarError) as e:
+        result['reason'] = repr(e)
+    if result['reason'] != None:
+        result['status'] = 'corrupt'
+    return result
 
-for f in tarlist:
-    dd = urllist[urllist[:,0]=='https://almascience.eso.org/dataPortal/'+f][:,1].astype('int') - os.path.getsize(f)
-    if dd > 0:
-        #print(f+' '+str(dd/1024/1024/1024))
-        ireg_f.append(f)
-        ireg_size.append(dd[0]/1024/1024/1024)
+if __name__ == '__main__':
+    with ThreadPoolExecutor(max_workers=max(1,min(nworker,len(tarlist)))) as executor:
+        results = list(executor.map(validate,tarlist))
 
-        if rmflag == 'rm':
-            os.system('rm -rf '+f)
+    exec_tarlist = [r['tarfilename'] for r in results if r['status'] == 'complete']
+    for r in results:
+        if r['status'] == '7m':
+            print(r['tarfilename']+' -> 7m, skipped')
+        elif r['status'] == 'unknown':
+            print(r['tarfilename']+' -> not in the manifests, skipped')
 
-    elif not ('https://almascience.eso.org/dataPortal/'+f in asdm12m[:,0]):
-        print(f+' -> 7m, skipped')
+    # truncated/corrupt downloads, removed in one batch
+    rmlist = [r['tarfilename'] for r in results if r['status'] in ['truncated','corrupt']]
+    if rmflag == 'rm' and rmlist != []:
+        FileOps.rm_rf(*rmlist)
 
-    else:
-        exec_tarlist.append(f)
+    dt_now = datetime.datetime.now()
+    ver = dt_now.isoformat().replace(':','-')
+    np.save('exec_tarlist.v'+ver+'.npy',np.array(exec_tarlist))
 
-dt_now = datetime.datetime.now()
-ver = dt_now.isoformat().replace(':','-')
-np.save('exec_tarlist.v'+ver+'.npy',np.array(exec_tarlist))
+    summary = {}
+    for r in results:
+        summary[r['status']] = summary.get(r['status'],0) + 1
+    report = {'created':dt_now.isoformat(),'manifest':args[1],'asdm12m':args[2],'check':check,'removed':(rmflag == 'rm'),
+              'summary':summary,'files':results}
+    with open('exec_tarlist.v'+ver+'.json','w') as fp:
+        json.dump(report,fp,indent=1)
 
-print('')
-print('### result ###')
-for (f,size) in zip(ireg_f,ireg_size):
-    print(f+' '+str(size))
+    print('')
+    print('### result ###')
+    print(' '.join(k+':'+str(v) for (k,v) in sorted(summary.items())))
+    for r in results:
+        if r['status'] in ['truncated','corrupt']:
+            print(r['tarfilename']+' '+r['status']+' '+str(r['reason']))
+    print('-> exec_tarlist.v'+ver+'.json')
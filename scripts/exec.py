@@ -3,49 +3,60 @@ import sys
 import numpy as np
 import time
 
+sys.path.append('.')
+import Lib_exec as Lib
+import Lib_manifest as Manifest
+import Lib_rundb as RunDB
+
 args = sys.argv
 
 dryrun = False
 nworker = int(args[2])
 
 from concurrent.futures import ThreadPoolExecutor
-from logging import StreamHandler, Formatter, INFO, getLogger
-
-flist = np.load(args[1])
+from logging import getLogger
+
+# tarball list (.npy) or validation report of check_and_run.py (.json, its complete tarballs)
+if args[1].endswith('.json'):
+    flist,reportsizes = Manifest.load_report(args[1])
+else:
+    flist = np.load(args[1])
+    reportsizes = None
 try:
     skipflag = args[3]
 except:
     skipflag = 'do'
 
-def init_logger():
-    handler = StreamHandler()
-    handler.setLevel(INFO)
-    handler.setFormatter(Formatter("[%(asctime)s] [%(threadName)s] %(message)s"))
-    logger = getLogger()
-    logger.addHandler(handler)
-    logger.setLevel(INFO)
+# spawn: one casa process per tarball, pool: persistent CASA workers
+try:
+    mode = args[4]
+except:
+    mode = 'spawn'
+
+# disk budget [GB] for concurrently running jobs (0: no budget, list order),
+# sizes from the URL manifest if given, otherwise from the tarballs on disk
+try:
+    budget = float(args[5])*1024**3
+except:
+    budget = 0.
+try:
+    manifest = Manifest.load_manifest(args[6])
+except:
+    manifest = reportsizes
+# projected peak disk usage of a job = tarball size x footprint_factor
+footprint_factor = 4.
+
+# run-state database (status, current step, elapsed, failures) for run_status.py;
+# the CASA processes find it through $ALMAQSO_RUNDB
+rundb = RunDB.RunDB(os.environ.get('ALMAQSO_RUNDB','./log/run.sqlite'))
+os.environ['ALMAQSO_RUNDB'] = rundb.path
 
 def casa_f(num):
     getLogger().info("%s start", num)
 
+    tarfilename = flist[num]
     if not dryrun:
-        tarfilename = flist[num]
-        cmdfile = 'exec_analysis.py'
-
-        os.system('mkdir -p python_scripts')
-        os.system('mkdir -p log')
-
-        f = open('./python_scripts/'+cmdfile.replace('.py','.'+tarfilename+'.py'),'w')
-        f.write('tarfilename = "'+tarfilename+'"'+'\n')
-        f.write('skipflag = "'+str(skipflag)+'"'+'\n')
-        f.write('execfile('+'"'+cmdfile+'"'+',globals())'+'\n')
-        f.close()
-
-        cmd = '"' + 'execfile('+"'"+'./python_scripts/'+cmdfile.replace('.py','.'+tarfilename+'.py')+"'"+')' +'"'
-        print('running: '+tarfilename)
-
-        os.system('touch ./log/'+tarfilename+'.term.log')
-        os.system('casa --nologger --nogui --logfile ./log/'+tarfilename+'.casa.log -c '+cmd+' >> '+'./log/'+tarfilename+'.term.log')
+        Lib.casa_spawn(tarfilename,skipflag=skipflag,rundb=rundb)
     else:
         print('dryrun: '+tarfilename)
 
@@ -55,7 +66,7 @@ def casa_f(num):
 def pipe_run():
     nFiles = flist.shape[0]
 
-    init_logger()
+    Lib.init_logger()
     getLogger().info("main start")
     with ThreadPoolExecutor(max_workers=min(nFiles,nworker), thread_name_prefix="thread") as executor:
         for i in range(nFiles):
@@ -63,5 +74,55 @@ def pipe_run():
         getLogger().info("submit end")
     getLogger().info("main end")
 
+def pool_run():
+    nFiles = flist.shape[0]
+
+    Lib.init_logger()
+    getLogger().info("main start (pool)")
+    pool = Lib.CASAWorkerPool(min(nFiles,nworker),rundb=rundb)
+    pool.start()
+
+    futures = [pool.submit(flist[i],skipflag=skipflag) for i in range(nFiles)]
+    getLogger().info("submit end")
+    for (i,future) in zip(range(nFiles),futures):
+        result = future.result()
+        getLogger().info("%s end (%s)", i, result['status'])
+        if result['status'] != 'done':
+            print('ERROR: '+result['tarfilename']+' -> '+str(result['reason']))
+
+    pool.stop()
+    getLogger().info("main end")
+
+def budget_run():
+    nFiles = flist.shape[0]
+
+    Lib.init_logger()
+    getLogger().info("main start (disk budget %.1f GB)", budget/1024.**3)
+    if mode == 'pool':
+        runner = Lib.CASAWorkerPool(min(nFiles,nworker),rundb=rundb)
+    else:
+        runner = Lib.CASASpawnPool(min(nFiles,nworker),rundb=rundb)
+    runner.start()
+
+    scheduler = Lib.DiskBudgetScheduler(runner,min(nFiles,nworker),budget,factor=footprint_factor)
+    results = scheduler.run(list(zip(flist,sizes)),skipflag=skipflag)
+    for result in results:
+        if result['status'] != 'done':
+            print('ERROR: '+result['tarfilename']+' -> '+str(result['reason']))
+
+    runner.stop()
+    getLogger().info("main end")
+
 if __name__ == '__main__':
-    pipe_run()
+    sizes = Lib.tarball_sizes(list(flist),manifest=manifest)
+    if not dryrun:
+        rundb.start_run(list(zip(flist,sizes)),nworker=nworker,mode=mode,budget=budget)
+
+    if dryrun:
+        pipe_run()
+    elif budget > 0.:
+        budget_run()
+    elif mode == 'pool':
+        pool_run()
+    else:
+        pipe_run()
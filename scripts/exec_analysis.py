@@ -9,34 +9,48 @@ import Lib_casa_analysis as Lib
 importlib.reload(Lib)
 
 casacmdforuvfit = os.environ.get('CASA_FOR_UVFIT')
+uvfit_nproc = int(os.environ.get('ALMAQSO_UVFIT_NPROC','1'))
+uvfitbackend = os.environ.get('ALMAQSO_UVFIT_BACKEND','casa')
+# memory ceiling [GB] for the visibility columns read/written at once in step5
+memlimit = float(os.environ.get('ALMAQSO_MEMLIMIT','2'))*1024**3
+# gain plot formats, comma separated: png, pdf, multipdf (e.g. 'png,multipdf' for bulk runs)
+plotformats = os.environ.get('ALMAQSO_PLOT_FORMATS','png,pdf').split(',')
+# 1: also fit/image the spw-combined average of each field (spw_all.avg)
+allspw = (os.environ.get('ALMAQSO_ALLSPW','0') == '1')
+# 1: sigma-clip outlier integrations of the averaged MS before the 2nd selfcal round (uvfit_flag_man)
+flagman = (os.environ.get('ALMAQSO_FLAGMAN','0') == '1')
 
-obj = Lib.QSOanalysis(tarfilename,casacmdforuvfit=casacmdforuvfit,spacesave=True)
+# skipflag: 'do' reruns from scratch, 'skip'/'resume' continue from the checkpoint manifest
+resume = (skipflag != 'do')
+obj = Lib.QSOanalysis(tarfilename,casacmdforuvfit=casacmdforuvfit,spacesave=True,resume=resume,fusesplit=True,uvfit_nproc=uvfit_nproc,uvfitbackend=uvfitbackend,memlimit=memlimit,allspw=allspw,plotformats=plotformats,flagman=flagman)
 
 asdmname = 'uid___' + (tarfilename.split('_uid___')[1]).replace('.asdm.sdm.tar','')
 
-if os.path.exists(asdmname) and skipflag == 'skip':
+if os.path.exists(asdmname) and skipflag == 'skip' and not os.path.exists(obj.checkpointfile):
     print(asdmname+': analysis already done and skip')
 
 else:
     if os.path.exists(asdmname):
-        print(asdmname+': analysis already done but reanalyzed')
+        if resume:
+            print(asdmname+': analysis already started, resumed from checkpoint')
+        else:
+            print(asdmname+': analysis already done but reanalyzed')
     print('step:0')
-    obj.intial_proc()
+    obj.runstep(0,obj.intial_proc)
     print('step:1')
-    obj.importasdm()
+    obj.runstep(1,obj.importasdm)
     print('step:2')
-    obj.gen_calib_script()
+    obj.runstep(2,obj.gen_calib_script)
     print('step:3')
-    obj.remove_target()
+    obj.runstep(3,obj.remove_target)
     print('step:4')
-    obj.doCalib()
-    obj.init_spacesave()
+    obj.runstep(4,obj.doCalib_spacesave)
     print('step:5')
-    obj.uvfit_run(plot=True)
+    obj.runstep(5,obj.uvfit_run,plot=True)
     print('step:6')
-    obj.cont_imaging()
+    obj.runstep(6,obj.cont_imaging)
     print('step:7')
-    obj.spacesaving(gzip=True)
+    obj.runstep(7,obj.spacesaving,gzip=True)
 
     print('step:8')
-    obj.specplot()
+    obj.runstep(8,obj.specplot)
@@ -1,41 +1,127 @@
+# links the spectra (specplot/*.png) and continuum images (imsg/*.image.fits) of ./data/uid___* into
+# figs/<telescope>/<field>/ and fits/<telescope>/<field>/, incrementally: ASDM directories whose mtime
+# did not change since the last run are skipped, links of removed products are removed.
+# The index (default products.index.json) keeps the state per ASDM and lists the products by
+# telescope/field/band for browsing.
+#
+# usage: python make_symlinks.py <12m list (.npy: ASDM names, or URL manifest(s), glob ok)> [index file] [full]
+
 import glob
 import os
 import sys
+import json
 import numpy as np
+
+sys.path.append('.')
+import Lib_fileops as FileOps
+import Lib_manifest as Manifest
 args = sys.argv
 
-asdmList = glob.glob('./data/uid___*')
-asdm12m = np.load(args[1])
-
-for f in asdmList:
-    imgs = glob.glob(f+'/specplot/*.png')
-    fitsimgs = glob.glob(f+'/imsg/*.image.fits')
-    asdm = f.replace('./data/','')
-
-    telescope = None
-    #print(asdm)
-    if asdm in asdm12m:
-        telescope = 'A12m'
-    else:
-        telescope = 'A7m'
-
-    if len(imgs) >= 1:
-        for img in imgs:
-            try:
-                field = 'J'+img.split('.J')[1].split('.spw')[0]
-                os.system('mkdir -p figs')
-                os.system('mkdir -p figs/'+telescope)
-                os.system('mkdir -p figs/'+telescope+'/'+field)
-                os.system('ln -sf '+os.path.abspath(img)+' '+'figs/'+telescope+'/'+field+'/')
-            except:
-                pass
-    if len(fitsimgs) >= 1:
-        for fitsimg in fitsimgs:
-            try:
-                field = 'J'+fitsimg.split('.J')[1].split('.residual.allspw.')[0]
-                os.system('mkdir -p fits')
-                os.system('mkdir -p fits/'+telescope)
-                os.system('mkdir -p fits/'+telescope+'/'+field)
-                os.system('ln -sf '+os.path.abspath(fitsimg)+' '+'fits/'+telescope+'/'+field+'/')
-            except:
-                pass
+try:
+    indexfile = args[2]
+except:
+    indexfile = 'products.index.json'
+full = ('full' in args[3:])
+
+# {asdm: band} of the 12m ASDMs (band '' when only names are given)
+def load_asdm12m(pattern):
+    asdm12m = {}
+    for path in sorted(glob.glob(pattern)):
+        arr = np.load(path)
+        if arr.dtype.names != None or (arr.ndim == 2 and arr.size > 0):
+            manifest = Manifest.load_manifest(path)
+            for (url,array,band) in zip(manifest['url'],manifest['array'],manifest['band']):
+                if array in ['12m','']:
+                    asdm12m[Manifest.asdmname_from_url(url)] = band
+        else:
+            for name in arr.ravel():
+                name = str(name)
+                if '/' in name:
+                    name = Manifest.asdmname_from_url(name)
+                asdm12m[name] = ''
+    return asdm12m
+
+def asdm_mtime(f):
+    return max([os.stat(d).st_mtime for d in [f,f+'/specplot',f+'/imsg'] if os.path.exists(d)])
+
+def asdm_products(f,telescope):
+    products = []
+    for img in glob.glob(f+'/specplot/*.png'):
+        try:
+            field = 'J'+img.split('.J')[1].split('.spw')[0]
+        except IndexError:
+            continue
+        products.append({'type':'figs','field':field,'path':os.path.abspath(img),'link':'figs/'+telescope+'/'+field+'/'+os.path.basename(img)})
+    for fitsimg in glob.glob(f+'/imsg/*.image.fits'):
+        try:
+            field = 'J'+fitsimg.split('.J')[1].split('.residual.allspw.')[0]
+        except IndexError:
+            continue
+        products.append({'type':'fits','field':field,'path':os.path.abspath(fitsimg),'link':'fits/'+telescope+'/'+field+'/'+os.path.basename(fitsimg)})
+    return products
+
+def update(index,asdm12m):
+    nnew = 0
+    nlink = 0
+    nunlink = 0
+    asdmList = glob.glob('./data/uid___*')
+    for f in asdmList:
+        asdm = f.replace('./data/','')
+        telescope = 'A12m' if asdm in asdm12m else 'A7m'
+        mtime = asdm_mtime(f)
+
+        old = index['asdms'].get(asdm)
+        if (not full) and old != None and old['mtime'] == mtime and old['telescope'] == telescope:
+            continue
+        nnew = nnew + 1
+
+        products = asdm_products(f,telescope)
+        links = set(p['link'] for p in products)
+        if old != None:
+            stale = [p['link'] for p in old['products'] if not p['link'] in links]
+            FileOps.rm_rf(*stale)
+            nunlink = nunlink + len(stale)
+            linked = set(p['link'] for p in old['products'])
+        else:
+            linked = set()
+
+        for p in products:
+            if full or not (p['link'] in linked and os.path.lexists(p['link'])):
+                FileOps.mkdir_p(os.path.dirname(p['link']))
+                FileOps.symlink(p['path'],p['link'])
+                nlink = nlink + 1
+
+        index['asdms'][asdm] = {'mtime':mtime,'telescope':telescope,'band':asdm12m.get(asdm,''),'products':products}
+
+    # ASDM directories that disappeared
+    present = set(f.replace('./data/','') for f in asdmList)
+    for asdm in list(index['asdms']):
+        if not asdm in present:
+            FileOps.rm_rf(*[p['link'] for p in index['asdms'][asdm]['products']])
+            nunlink = nunlink + len(index['asdms'][asdm]['products'])
+            del index['asdms'][asdm]
+
+    print(str(len(asdmList))+' ASDMs, '+str(nnew)+' new/changed, '+str(nlink)+' links made, '+str(nunlink)+' removed')
+
+# {telescope: {field: {band: [product paths]}}}
+def product_tree(index):
+    tree = {}
+    for (asdm,entry) in sorted(index['asdms'].items()):
+        for p in entry['products']:
+            tree.setdefault(entry['telescope'],{}).setdefault(p['field'],{}).setdefault(entry['band'],[]).append(p['path'])
+    return tree
+
+if __name__ == '__main__':
+    asdm12m = load_asdm12m(args[1])
+
+    index = {'asdms':{}}
+    if os.path.exists(indexfile) and not full:
+        with open(indexfile,'r') as fp:
+            index = json.load(fp)
+
+    update(index,asdm12m)
+    index['products'] = product_tree(index)
+
+    with open(indexfile+'.tmp','w') as fp:
+        json.dump(index,fp,indent=1)
+    os.replace(indexfile+'.tmp',indexfile)
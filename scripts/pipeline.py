@@ -0,0 +1,147 @@
+# streaming download -> analysis pipeline
+# each tarball is handed to CASA (exec_analysis.py) as soon as its download is verified,
+# with separate pools for network I/O and CASA, and downloads held back while free disk is low
+#
+# usage: python pipeline.py <manifest.npy> <n_download> <n_casa> [minfree GB] [skipflag] [spawn|pool]
+
+import os
+import sys
+import time
+import threading
+import numpy as np
+
+sys.path.append('.')
+import Lib_exec as Lib
+import Lib_manifest as Manifest
+import Lib_download as Download
+import Lib_rundb as RunDB
+
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+args = sys.argv
+
+manifest = Manifest.load_manifest(args[1])
+ndownload = int(args[2])
+ncasa = int(args[3])
+try:
+    minfree = float(args[4])*1024**3
+except:
+    minfree = 500*1024**3
+try:
+    skipflag = args[5]
+except:
+    skipflag = 'do'
+try:
+    mode = args[6]
+except:
+    mode = 'spawn'
+
+only12m = True
+usemirrors = True
+# downloaded tarballs waiting for CASA; downloads pause while the backlog is full
+maxbacklog = 2*ncasa
+# projected peak disk footprint of one job [x tarball size] (tar, asdm, .ms/.ms.org/.split), as in exec.py
+footprint_factor = 4.
+
+# one row per tarball, 7m/TP data are skipped (as in check_and_run.py)
+urls,uniq = np.unique(manifest['url'],return_index=True)
+manifest = manifest[uniq]
+if only12m:
+    manifest = manifest[(manifest['array'] == '12m') | (manifest['array'] == '')]
+
+# run-state database for run_status.py, shared with the CASA processes through $ALMAQSO_RUNDB
+rundb = RunDB.RunDB(os.environ.get('ALMAQSO_RUNDB','./log/run.sqlite'))
+os.environ['ALMAQSO_RUNDB'] = rundb.path
+
+def pipe_run():
+    Lib.init_logger()
+    getLogger().info("main start: %s tarballs, %.1f GB", manifest.shape[0], manifest['size'].sum()/1024.**3)
+
+    mirrors = None
+    if usemirrors and manifest.shape[0] > 0:
+        mirrors = Download.MirrorSelector(Download.mirrors)
+        mirrors.probe(Download.split_mirror(manifest['url'][0])[1])
+
+    downloader = Download.Downloader(download_d='./',nworker=ndownload,mirrors=mirrors)
+    gate = Lib.DiskGate(path='.',minfree=minfree)
+    backlog = threading.BoundedSemaphore(maxbacklog)
+
+    rundb.start_run([(Manifest.tarfilename_from_url(url),size) for (url,size) in zip(manifest['url'],manifest['size'])],
+                    ndownload=ndownload,ncasa=ncasa,mode=mode)
+    if mode == 'pool':
+        casa = Lib.CASAWorkerPool(ncasa,rundb=rundb)
+    else:
+        casa = Lib.CASASpawnPool(ncasa,rundb=rundb)
+    casa.start()
+
+    lock = threading.Lock()
+    casa_futures = []
+
+    def analysis_done(tarfilename,future):
+        backlog.release()
+        gate.release(tarfilename)
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {'tarfilename':tarfilename,'status':'failed','reason':repr(e),'elapsed':None}
+            rundb.job_finished(result)
+        getLogger().info("%s analysis %s", tarfilename, result['status'])
+        if result['status'] != 'done':
+            print('ERROR: '+tarfilename+' -> '+str(result['reason']))
+
+    def download_f(url,size):
+        tarfilename = Manifest.tarfilename_from_url(url)
+        asdmname = Manifest.asdmname_from_url(url)
+        # same test as exec_analysis.py: an ASDM with a checkpoint manifest is resumed, not skipped
+        checkpointfile = os.path.join(asdmname,'log',asdmname+'.checkpoint.json')
+        if os.path.exists(asdmname) and skipflag == 'skip' and not os.path.exists(checkpointfile):
+            getLogger().info("%s already analyzed, skipped", tarfilename)
+            rundb.job_finished({'tarfilename':tarfilename,'status':'skipped','reason':None,'elapsed':None})
+            return
+        # the tarball of a resumed ASDM was moved into its directory at step 0
+        resumed = (skipflag != 'do' and os.path.exists(checkpointfile))
+
+        # disk is reserved for the projected peak footprint until the analysis ends
+        backlog.acquire()
+        gate.acquire(tarfilename,size*footprint_factor,usage=lambda: Lib.job_disk_usage(tarfilename,asdmname))
+        submitted = False
+        try:
+            if not resumed:
+                result = downloader.download(url,size)
+                if result['status'] != 'done':
+                    print('ERROR: '+url+' -> '+str(result['reason']))
+                    rundb.job_finished({'tarfilename':tarfilename,'status':'failed','reason':'download: '+str(result['reason']),'elapsed':None})
+                    return
+                getLogger().info("%s downloaded -> analysis", tarfilename)
+            else:
+                getLogger().info("%s resumed from checkpoint -> analysis", tarfilename)
+
+            future = casa.submit(tarfilename,skipflag=skipflag)
+            submitted = True
+            future.add_done_callback(lambda future: analysis_done(tarfilename,future))
+            with lock:
+                casa_futures.append(future)
+        except Exception as e:
+            print('ERROR: '+url+' -> '+repr(e))
+            rundb.job_finished({'tarfilename':tarfilename,'status':'failed','reason':repr(e),'elapsed':None})
+        finally:
+            if not submitted:
+                gate.release(tarfilename)
+                backlog.release()
+
+    downloader.t0 = time.time()
+    with ThreadPoolExecutor(max_workers=max(1,ndownload), thread_name_prefix="download") as executor:
+        futures = [executor.submit(download_f,url,int(size)) for (url,size) in zip(manifest['url'],manifest['size'])]
+    for future in futures:
+        if future.exception() != None:
+            print('ERROR: '+repr(future.exception()))
+    getLogger().info("downloads end (%.1f MB/s)", downloader.throughput())
+
+    for future in casa_futures:
+        future.exception()
+    casa.stop()
+    getLogger().info("main end")
+
+if __name__ == '__main__':
+    pipe_run()
@@ -0,0 +1,94 @@
+# progress of a running (or finished) exec.py / pipeline.py run from its run-state database
+# usage: python run_status.py [run.sqlite (default: $ALMAQSO_RUNDB or ./log/run.sqlite)] [refresh interval s]
+#   throughput (EBs/hour, GB/hour) over the whole run and the last hour, ETA, running jobs with
+#   their current step, failed jobs with their exit status
+
+import os
+import sys
+import time
+
+sys.path.append('.')
+import Lib_rundb as RunDB
+
+args = sys.argv
+
+try:
+    path = args[1]
+except:
+    path = os.environ.get('ALMAQSO_RUNDB','./log/run.sqlite')
+try:
+    interval = float(args[2])
+except:
+    interval = 0.
+
+def hms(seconds):
+    if seconds == None:
+        return '-'
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds//3600,seconds%3600//60,seconds%60)
+
+def rates(done,t0,t1):
+    hours = max(t1-t0,1.)/3600.
+    return len(done)/hours,sum(job['size'] for job in done)/1024.**3/hours
+
+def status(db):
+    now = time.time()
+    run = db.get_run()
+    jobs = db.jobs()
+    if jobs == []:
+        print(path+': no jobs')
+        return
+
+    bystatus = {}
+    for job in jobs:
+        bystatus.setdefault(job['status'],[]).append(job)
+    done = bystatus.get('done',[])
+    failed = bystatus.get('failed',[])
+    running = bystatus.get('running',[])
+    queued = bystatus.get('queued',[])
+
+    t0 = float(run.get('started',min(job['queued'] for job in jobs)))
+    eb_h,gb_h = rates(done,t0,now)
+    recent = [job for job in done if job['finished'] > now-3600.]
+    eb_h1,gb_h1 = rates(recent,max(t0,now-3600.),now)
+
+    remaining = queued+running
+    remaining_gb = sum(job['size'] for job in remaining)/1024.**3
+    eta = None
+    if gb_h > 0. and remaining_gb > 0.:
+        eta = remaining_gb/gb_h*3600.
+    elif eb_h > 0.:
+        eta = len(remaining)/eb_h*3600.
+
+    print(time.strftime('%Y-%m-%d %H:%M:%S')+'  '+path+'  ('+', '.join(k+'='+v for (k,v) in sorted(run.items()) if k != 'started')+')')
+    print('elapsed {}  jobs {}: {} done, {} failed, {} running, {} queued, {} other'.format(
+        hms(now-t0),len(jobs),len(done),len(failed),len(running),len(queued),len(jobs)-len(done)-len(failed)-len(running)-len(queued)))
+    print('throughput {:.2f} EB/h, {:.1f} GB/h (last hour {:.2f} EB/h, {:.1f} GB/h)'.format(eb_h,gb_h,eb_h1,gb_h1))
+    if done != []:
+        print('elapsed per EB: mean {}, max {}'.format(hms(sum(job['elapsed'] for job in done)/len(done)),hms(max(job['elapsed'] for job in done))))
+    print('remaining {} EBs, {:.1f} GB, ETA {}'.format(len(remaining),remaining_gb,hms(eta)))
+
+    if running != []:
+        print('')
+        print('running:')
+        for job in sorted(running,key=lambda job: job['started']):
+            step = '-' if job['step'] == None else job['step']+' ('+hms(now-job['stepstarted'])+')'
+            print('  {:<60} {:>10}  step {}'.format(job['tarfilename'],hms(now-job['started']),step))
+
+    if failed != []:
+        print('')
+        print('failed:')
+        for job in sorted(failed,key=lambda job: job['finished']):
+            print('  {:<60} step {:<20} {}'.format(job['tarfilename'],str(job['step']),str(job['exitstatus'])))
+
+if __name__ == '__main__':
+    if not os.path.exists(path):
+        print(path+' not found')
+        sys.exit(1)
+    db = RunDB.RunDB(path)
+    while True:
+        status(db)
+        if interval <= 0.:
+            break
+        time.sleep(interval)
+        print('')
@@ -7,6 +7,7 @@ import json
 sys.path.append('.')
 import Lib_python_analysis as Lib
 importlib.reload(Lib)
+import Lib_manifest as Manifest
 args = sys.argv
 
 band = str(args[1])
@@ -14,10 +15,36 @@ os.system('mkdir -p urls')
 dryrun = False
 
 jfilename = args[2]
+
+# serial: one TAP query per source, batch: 'target_name IN (...)' chunks + concurrent get_data_info
+try:
+    mode = args[3]
+except:
+    mode = 'serial'
+try:
+    nworker = int(args[4])
+except:
+    nworker = 8
+try:
+    almaurl = args[5]
+except:
+    almaurl = 'https://almascience.eso.org'
+if almaurl == 'auto':
+    almaurl = Lib.select_almaurl()
 f = open(jfilename,'r')
 jdict = json.load(f)
 f.close()
 
+# query cache: ALMAQSO_CACHE (sqlite file), ALMAQSO_CACHE_TTL (days), ALMAQSO_CACHE_MAXSIZE (GB)
+# ALMAQSO_OFFLINE=1 answers purely from the cache, ALMAQSO_REFRESH=1 rebuilds existing urls/*.npy
+cache = Lib.QueryCache(
+    path=os.environ.get('ALMAQSO_CACHE','./cache/almaquery.sqlite'),
+    ttl=float(os.environ.get('ALMAQSO_CACHE_TTL','30'))*86400.,
+    maxsize=float(os.environ.get('ALMAQSO_CACHE_MAXSIZE','2'))*1024**3,
+    offline=(os.environ.get('ALMAQSO_OFFLINE','0') == '1'),
+    )
+refresh = (os.environ.get('ALMAQSO_REFRESH','0') == '1')
+
 cals = []
 for i in range(len(jdict)):
      cals.append(jdict[i]['names'][0]['name'])
@@ -25,23 +52,55 @@ for i in range(len(jdict)):
 cals = np.unique(cals)
 print(cals.shape)
 
-for i in range(cals.shape[0]):
-    #sname = jdict[i]['names'][0]['name']
-    sname = cals[i]
+def save_urls(i,sname,obj):
+    Manifest.save_manifest('./urls/'+sname+'.B'+band+'.npy',obj.url_list)
+    print('['+str(i+1)+'/'+str(cals.shape[0])+'] '+'Totla size('+sname+' B'+band+'): '+str(obj.total_size)+' GB')
 
-    if os.path.exists('./urls/'+sname+'.B'+band+'.npy'):
-        print('['+str(i+1)+'/'+str(cals.shape[0])+'] '+sname+' -> skipped')
+def serial_run():
+    for i in range(cals.shape[0]):
+        #sname = jdict[i]['names'][0]['name']
+        sname = cals[i]
+
+        if os.path.exists('./urls/'+sname+'.B'+band+'.npy') and not refresh:
+            print('['+str(i+1)+'/'+str(cals.shape[0])+'] '+sname+' -> skipped')
 
-    else:
-        if dryrun:
-            pass
-            print('['+str(i+1)+'/'+str(cals.shape[0])+'] '+sname+' -> dydrun')
         else:
-            try:
-                print('['+str(i+1)+'/'+str(cals.shape[0])+'] '+sname+' -> start!')
-                obj = Lib.QSOquery(sname,band=band,almaurl='https://almascience.eso.org',download_d='./',replaceNAOJ=True,only12m=True,onlyFDM=True)
-                obj.get_data_urls(almaquery=False)
-                np.save('./urls/'+sname+'.B'+band+'.npy',obj.url_list)
-                print('Totla size('+sname+' B'+band+'): '+str(obj.total_size)+' GB')
-            except:
-                print('ERROR: '+sname+' -> failed (maybe no matched data) and skipped')
+            if dryrun:
+                pass
+                print('['+str(i+1)+'/'+str(cals.shape[0])+'] '+sname+' -> dydrun')
+            else:
+                try:
+                    print('['+str(i+1)+'/'+str(cals.shape[0])+'] '+sname+' -> start!')
+                    obj = Lib.QSOquery(sname,band=band,almaurl=almaurl,download_d='./',replaceNAOJ=True,only12m=True,onlyFDM=True,cache=cache)
+                    obj.get_data_urls(almaquery=False)
+                    save_urls(i,sname,obj)
+                except:
+                    print('ERROR: '+sname+' -> failed (maybe no matched data) and skipped')
+
+def batch_f(i,sname,rlist):
+    try:
+        obj = Lib.QSOquery(sname,band=band,almaurl=almaurl,download_d='./',replaceNAOJ=True,only12m=True,onlyFDM=True,cache=cache)
+        obj.get_data_urls(almaquery=False,rlist=rlist)
+        save_urls(i,sname,obj)
+    except:
+        print('ERROR: '+sname+' -> failed (maybe no matched data) and skipped')
+
+def batch_run():
+    todo = [i for i in range(cals.shape[0]) if refresh or not os.path.exists('./urls/'+cals[i]+'.B'+band+'.npy')]
+    print(str(cals.shape[0]-len(todo))+' sources skipped (already done)')
+    if dryrun or todo == []:
+        return
+
+    rlists = Lib.query_batch(cals[todo],band=band,almaurl=almaurl,almaquery=False,only12m=True,onlyFDM=True,cache=cache)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=nworker, thread_name_prefix="thread") as executor:
+        for i in todo:
+            if cals[i] in rlists:
+                executor.submit(batch_f,i,cals[i],rlists[cals[i]])
+
+if __name__ == '__main__':
+    if mode == 'batch':
+        batch_run()
+    else:
+        serial_run()
@@ -0,0 +1,81 @@
+# aggregate the step records (log/<asdm>.steps.jsonl written by QSOanalysis) of a run
+# usage: python step_report.py [workdir or *.steps.jsonl ...] [ntop]
+#   per step: runs, failures, total/mean/max wall time, cpu time, peak RSS (of the steps that raised it), disk written/deleted, largest MS
+#   per-(field, spw) chains of step5 are aggregated as '5/chain'
+
+import os
+import sys
+import glob
+import json
+
+args = sys.argv
+
+paths = [arg for arg in args[1:] if not arg.isdigit()]
+if paths == []:
+    paths = ['.']
+ntop = ([int(arg) for arg in args[1:] if arg.isdigit()]+[10])[0]
+
+def steps_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = files + sorted(glob.glob(os.path.join(path,'uid___*','log','*.steps.jsonl')))
+            files = files + sorted(glob.glob(os.path.join(path,'log','*.steps.jsonl')))
+        else:
+            files = files + sorted(glob.glob(path))
+    return files
+
+def load_records(files):
+    records = []
+    for f in files:
+        with open(f,'r') as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # line cut by a killed run
+                    pass
+    return records
+
+def step_group(record):
+    if record['step'].startswith('5/'):
+        return '5/chain'
+    return record['step']+':'+record['name']
+
+def aggregate(records):
+    groups = {}
+    for r in records:
+        g = groups.setdefault(step_group(r),{'n':0,'failed':0,'wall':0.,'wallmax':0.,'cpu':0.,'rss':0,'written':0,'deleted':0,'ms':0,'asdms':set()})
+        g['n'] = g['n'] + 1
+        g['failed'] = g['failed'] + (r['status'] != 'OK')
+        g['wall'] = g['wall'] + r['wall']
+        g['wallmax'] = max(g['wallmax'],r['wall'])
+        g['cpu'] = g['cpu'] + r['cpu_self'] + r['cpu_children']
+        # null: the step stayed below an earlier peak of its process
+        g['rss'] = max([g['rss']]+[rss for rss in [r['maxrss_self'],r['maxrss_children']] if rss != None])
+        g['written'] = g['written'] + r.get('disk_written',0)
+        g['deleted'] = g['deleted'] + r.get('disk_deleted',0)
+        g['ms'] = max([g['ms']]+list(r.get('ms_sizes',{}).values()))
+        g['asdms'].add(r['asdm'])
+    return groups
+
+def report(records,ntop=10):
+    groups = aggregate(records)
+    total = sum(g['wall'] for (k,g) in groups.items() if k != '5/chain')
+    GB = 1024.**3
+
+    print('{} records, {} ASDMs, {:.1f} h in steps'.format(len(records),len(set(r['asdm'] for r in records)),total/3600.))
+    print('{:<24} {:>5} {:>5} {:>9} {:>6} {:>9} {:>9} {:>9} {:>8} {:>9} {:>9} {:>8}'.format(
+        'step','runs','fail','wall[h]','[%]','mean[s]','max[s]','cpu[h]','rss[GB]','write[GB]','del[GB]','ms[GB]'))
+    for (k,g) in sorted(groups.items(),key=lambda kg: -kg[1]['wall']):
+        print('{:<24} {:>5} {:>5} {:>9.2f} {:>6.1f} {:>9.0f} {:>9.0f} {:>9.2f} {:>8.2f} {:>9.1f} {:>9.1f} {:>8.2f}'.format(
+            k,g['n'],g['failed'],g['wall']/3600.,(100.*g['wall']/total if total > 0 and k != '5/chain' else 0.),g['wall']/g['n'],g['wallmax'],
+            g['cpu']/3600.,g['rss']/GB,g['written']/GB,g['deleted']/GB,g['ms']/GB))
+
+    print('')
+    print('slowest {}:'.format(ntop))
+    for r in sorted(records,key=lambda r: -r['wall'])[:ntop]:
+        print('{:>9.0f} s  {:<8} {:<40} {}'.format(r['wall'],r['status'],r['asdm'],r['step']+':'+r['name']))
+
+if __name__ == '__main__':
+    report(load_records(steps_files(paths)),ntop=ntop)
@@ -0,0 +1,42 @@
+# warm uvmultifit worker for QSOanalysis (uvfitbackend='worker')
+# started by Lib_casa_analysis.UVFitService as: $CASA_FOR_UVFIT --nologger --nogui --nologfile -c uvmultifit_worker.py
+# runs in the CASA used for uvmultifit (CASA 5.6, python 2.7): keep it python 2 compatible
+
+import os
+import json
+import binascii
+import traceback
+from multiprocessing.connection import Client
+from NordicARC import uvmultifit as uvm
+
+def tostr(obj):
+    # json gives unicode in python 2, uvmultifit expects str
+    if isinstance(obj,dict):
+        return dict([(tostr(k),tostr(v)) for (k,v) in obj.items()])
+    if isinstance(obj,list):
+        return [tostr(v) for v in obj]
+    if (not isinstance(obj,str)) and hasattr(obj,'encode') and str is bytes:
+        return obj.encode('utf-8')
+    return obj
+
+host,port = os.environ['ALMAQSO_UVFIT_ADDRESS'].split(':')
+conn = Client((host,int(port)),authkey=binascii.unhexlify(os.environ['ALMAQSO_UVFIT_AUTHKEY']))
+
+while True:
+    try:
+        job = json.loads(conn.recv_bytes().decode('utf-8'))
+    except EOFError:
+        break
+    if job == None:
+        break
+
+    reply = {'status':'OK','error':None}
+    try:
+        os.chdir(job['cwd'])
+        myfit = uvm.uvmultifit(**tostr(job['kw_uvfit']))
+    except Exception:
+        reply = {'status':'failed','error':traceback.format_exc()}
+
+    conn.send_bytes(json.dumps(reply).encode('utf-8'))
+
+conn.close()
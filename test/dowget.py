@@ -2,17 +2,25 @@ import os
 import sys
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'../scripts'))
+sys.path.append('.')
+import Lib_manifest as Manifest
+import Lib_download as Download
+
 args = sys.argv
 
 replaceNAOJ = True
+# probe the archive mirrors and fail over between them (overrides replaceNAOJ)
+usemirrors = True
 dryrun = False
 download_d = args[2]
 nworker = 10
 
-from concurrent.futures import ThreadPoolExecutor
 from logging import StreamHandler, Formatter, INFO, getLogger
 
-flist = np.unique(np.load(args[1])[:,0])
+manifest = Manifest.load_manifest(args[1])
+flist,uniq = np.unique(manifest['url'],return_index=True)
+sizes = manifest['size'][uniq]
 
 def init_logger():
     handler = StreamHandler()
@@ -22,31 +30,26 @@ def init_logger():
     logger.addHandler(handler)
     logger.setLevel(INFO)
 
-def wget_f(num):
-    getLogger().info("%s start", num)
-    if replaceNAOJ:
-        download_url = (flist[num]).replace("https://almascience.eso.org","https://almascience.nao.ac.jp")
-    else:
-        download_url = flist[num]
-    print('wget -q --no-check-certificate -P '+download_d+' '+download_url)
-
-    if not dryrun:
-        os.system('wget -q --no-check-certificate -P '+download_d+' '+download_url)
-    getLogger().info("%s end", num)
-
-
 def download():
-    nFiles = flist.shape[0]
-
     init_logger()
     getLogger().info("main start")
-    with ThreadPoolExecutor(max_workers=min(nFiles,nworker), thread_name_prefix="thread") as executor:
-        for i in range(nFiles):
-            executor.submit(wget_f, i)
-        getLogger().info("submit end")
+
+    mirrors = None
+    urls = list(flist)
+    if usemirrors:
+        mirrors = Download.MirrorSelector(Download.mirrors)
+        if not dryrun:
+            mirrors.probe(Download.split_mirror(urls[0])[1])
+    elif replaceNAOJ:
+        urls = [url.replace("https://almascience.eso.org","https://almascience.nao.ac.jp") for url in flist]
+
+    if dryrun:
+        for url in urls:
+            print('download: '+url)
+    else:
+        downloader = Download.Downloader(download_d=download_d,nworker=nworker,mirrors=mirrors)
+        downloader.run(urls,sizes=list(sizes))
     getLogger().info("main end")
 
 if __name__ == '__main__':
     download()
-
-###
@@ -0,0 +1,170 @@
+# Lib_download.Downloader against a local http.server
+# usage: python -m pytest test/test_download.py (or python test/test_download.py)
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'../scripts'))
+import Lib_download as Download
+
+payload = bytes(range(256))*4096  # 1 MiB
+
+class Handler(BaseHTTPRequestHandler):
+    # server.truncate: number of responses still to cut short (Content-Length promised, body cut in half)
+    # server.chunked: the cut responses use chunked transfer encoding (client sees IncompleteRead)
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        start = 0
+        rng = self.headers.get('Range')
+        if rng != None:
+            start = int(rng.split('=')[1].split('-')[0])
+            if start >= len(payload):
+                self.send_response(416)
+                self.send_header('Content-Range','bytes */'+str(len(payload)))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range','bytes '+str(start)+'-'+str(len(payload)-1)+'/'+str(len(payload)))
+        else:
+            self.send_response(200)
+        body = payload[start:]
+        if self.server.truncate > 0 and self.server.chunked:
+            self.server.truncate = self.server.truncate - 1
+            self.send_header('Transfer-Encoding','chunked')
+            self.end_headers()
+            half = body[:len(body)//2]
+            self.wfile.write(('%x' % len(body)).encode()+b'\r\n'+half)
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        if self.server.truncate > 0:
+            self.server.truncate = self.server.truncate - 1
+            self.wfile.write(body[:len(body)//2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('localhost',0),Handler)
+        self.server.truncate = 0
+        self.server.chunked = False
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        self.url = 'http://localhost:'+str(self.server.server_address[1])+'/dataPortal/test.tar'
+        self.tmpdir = tempfile.mkdtemp()
+        self.downloader = Download.Downloader(download_d=self.tmpdir,nworker=2,retries=3,backoff=0.,timeout=10.,chunksize=64*1024)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def target(self):
+        return os.path.join(self.tmpdir,'test.tar')
+
+    def test_download(self):
+        result = self.downloader.download(self.url,len(payload))
+        self.assertEqual(result['status'],'done')
+        self.assertEqual(open(self.target(),'rb').read(),payload)
+
+    def test_range_resume(self):
+        with open(self.target()+'.part','wb') as f:
+            f.write(payload[:1000])
+        result = self.downloader.download(self.url,len(payload))
+        self.assertEqual(result['status'],'done')
+        self.assertEqual(self.server.requests,['bytes=1000-'])
+        self.assertEqual(open(self.target(),'rb').read(),payload)
+
+    def test_truncated_body_is_retried(self):
+        self.server.truncate = 1
+        result = self.downloader.download(self.url,len(payload))
+        self.assertEqual(result['status'],'done')
+        self.assertEqual(len(self.server.requests),2)
+        self.assertEqual(self.server.requests[0],None)
+        self.assertTrue(self.server.requests[1].startswith('bytes='))
+        self.assertEqual(open(self.target(),'rb').read(),payload)
+
+    def test_truncated_chunked_body_is_retried(self):
+        self.server.truncate = 1
+        self.server.chunked = True
+        result = self.downloader.download(self.url,len(payload))
+        self.assertEqual(result['status'],'done')
+        self.assertEqual(len(self.server.requests),2)
+        self.assertEqual(open(self.target(),'rb').read(),payload)
+
+    def test_truncated_body_exhausts_retries(self):
+        self.server.truncate = 100
+        result = self.downloader.download(self.url,len(payload))
+        self.assertEqual(result['status'],'failed')
+        self.assertFalse(os.path.exists(self.target()))
+
+    def test_416_complete_part(self):
+        with open(self.target()+'.part','wb') as f:
+            f.write(payload)
+        result = self.downloader.download(self.url,len(payload))
+        self.assertEqual(result['status'],'done')
+        self.assertEqual(self.server.requests,['bytes='+str(len(payload))+'-'])
+
+    def test_size_check(self):
+        result = self.downloader.download(self.url,len(payload)+10)
+        self.assertEqual(result['status'],'failed')
+        self.assertTrue('truncated' in result['reason'])
+        result = self.downloader.download(self.url,len(payload)-10)
+        self.assertEqual(result['status'],'failed')
+        self.assertTrue('size mismatch' in result['reason'])
+
+    def test_run_never_raises(self):
+        self.server.truncate = 100
+        self.server.chunked = True
+        results = self.downloader.run([self.url,'http://localhost:1/dataPortal/none.tar'],sizes=[len(payload),None])
+        self.assertEqual([r['status'] for r in results],['failed','failed'])
+
+class MirrorFailoverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+        for truncate in [100,0]:
+            server = ThreadingHTTPServer(('localhost',0),Handler)
+            server.truncate = truncate
+            server.chunked = False
+            server.requests = []
+            threading.Thread(target=server.serve_forever,daemon=True).start()
+            self.servers.append(server)
+        self.mirrors = ['http://localhost:'+str(server.server_address[1]) for server in self.servers]
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_short_read_fails_over(self):
+        # a long backoff: only an immediate failover finishes in time
+        downloader = Download.Downloader(download_d=self.tmpdir,retries=3,backoff=60.,timeout=10.,chunksize=64*1024,
+                                         mirrors=Download.MirrorSelector(self.mirrors))
+        t0 = time.time()
+        result = downloader.download(self.mirrors[0]+'/dataPortal/test.tar',len(payload))
+        self.assertEqual(result['status'],'done')
+        self.assertLess(time.time()-t0,30.)
+        self.assertEqual(len(self.servers[0].requests),1)
+        self.assertEqual(len(self.servers[1].requests),1)
+        self.assertTrue(self.servers[1].requests[0].startswith('bytes='))
+        self.assertEqual(open(os.path.join(self.tmpdir,'test.tar'),'rb').read(),payload)
+
+if __name__ == '__main__':
+    unittest.main()